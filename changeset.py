@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""Changes between two releases of NCBI taxonomy.
+
+Change set lists what has to be re-resolved in files already annotated by
+the mapper. It is a tab separated file with these kinds of lines:
+    T   taxid   old scientific name   - node renamed, moved, re-ranked or
+                                        removed
+    A   accession                     - protein link added, removed or
+                                        pointing to a different taxid
+    L   not compared                  - links were not compared, changed
+                                        links are missing from the change set
+
+Names are kept, because lineage tags in annotated files contain names only.
+Every lineage containing an old name of a changed node may have changed.
+
+To create a change set type:
+python changeset.py [OLD_NCBI_DIR] [NEW_NCBI_DIR] [OUT_FILE]
+
+Both directories have to contain names.dmp, nodes.dmp and
+prot.accession2taxid. To compare nodes only, e.g. if links of a release are
+not available, add --skip-links:
+python changeset.py [OLD_NCBI_DIR] [NEW_NCBI_DIR] [OUT_FILE] --skip-links
+"""
+
+# External libraries imports
+from os import sys
+import os
+
+# Internal modules import
+import ncbi_taxonomies as ncbi
+from sortmerge import external_sort
+
+
+class ChangeSet(object):
+    """Changed taxids, names and accessions between two releases."""
+
+    def __init__(self):
+        self.taxids = set()
+        self.names = set()
+        self.accessions = set()
+        self.links_compared = True
+
+    @classmethod
+    def read(cls, file_path):
+        """Reads change set from a file.
+
+        Params:
+            file_path (str): Path to a change set file
+
+        Returns:
+            changes (ChangeSet): Change set
+        """
+
+        changes = cls()
+
+        with open(file_path, 'r') as in_file:
+            for line in in_file:
+                fields = line.rstrip('\n').split('\t')
+
+                if fields[0] == 'T':
+                    changes.taxids.add(fields[1])
+                    changes.names.add(fields[2])
+                elif fields[0] == 'A':
+                    changes.accessions.add(fields[1])
+                elif fields[0] == 'L':
+                    changes.links_compared = False
+
+        return changes
+
+    def lineage_changed(self, lineage):
+        """Checks whether lineage contains a changed node.
+
+        Params:
+            lineage (list): Names of nodes in a lineage
+
+        Returns:
+            changed (bool): Whether lineage may have changed
+
+        e.g.:
+        >>> changes = ChangeSet()
+        >>> changes.names.add('Bacteria')
+        >>> changes.lineage_changed(['cellular organisms', 'Bacteria'])
+        True
+        >>> changes.lineage_changed(['cellular organisms', 'Archaea'])
+        False
+        """
+
+        return any(name in self.names for name in lineage)
+
+
+def iter_nodes(ncbi_dir):
+    """Iterates over nodes of a release, sorted by taxid."""
+
+    for batch in ncbi.join_nodes('%s/names.dmp' % ncbi_dir,
+                                 '%s/nodes.dmp' % ncbi_dir):
+        for node in batch:
+            yield node
+
+
+def diff_nodes(old_nodes, new_nodes):
+    """Compares two streams of nodes sorted by taxid.
+
+    Params:
+        old_nodes (iterable): Nodes of the old release
+        new_nodes (iterable): Nodes of the new release
+
+    Returns:
+        Generator yielding old nodes which were renamed, moved, re-ranked
+        or removed.
+
+    e.g.:
+    >>> from own_objects import Node
+    >>> old = [Node('2', 'A', '1'), Node('6', 'B', '2'), Node('7', 'C', '6')]
+    >>> new = [Node('2', 'A', '1'), Node('7', 'C', '2'), Node('9', 'D', '2')]
+    >>> [node.taxid for node in diff_nodes(old, new)]
+    ['6', '7']
+    """
+
+    new_nodes = iter(new_nodes)
+    new = next(new_nodes, None)
+
+    for old in old_nodes:
+        # Skip nodes added in the new release
+        while new is not None and int(new.taxid) < int(old.taxid):
+            new = next(new_nodes, None)
+
+        if (new is None or new.taxid != old.taxid or
+                new.scientific_name != old.scientific_name or
+                new.upper_hierarchy != old.upper_hierarchy or
+                new.node_type != old.node_type):
+            yield old
+
+
+def diff_links(old_links, new_links):
+    """Compares two streams of (accession, taxid) links sorted by accession.
+
+    Params:
+        old_links (iterable): Links of the old release
+        new_links (iterable): Links of the new release
+
+    Returns:
+        Generator yielding accessions added, removed or pointing to
+        a different taxid.
+
+    e.g.:
+    >>> old = [('P1', '9606'), ('P2', '10090'), ('P4', '9913')]
+    >>> new = [('P1', '9606'), ('P3', '8355'), ('P4', '9823')]
+    >>> list(diff_links(old, new))
+    ['P2', 'P3', 'P4']
+    """
+
+    old_links = iter(old_links)
+    new_links = iter(new_links)
+    old = next(old_links, None)
+    new = next(new_links, None)
+
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old[0]
+            old = next(old_links, None)
+        elif old is None or new[0] < old[0]:
+            yield new[0]
+            new = next(new_links, None)
+        else:
+            if old[1] != new[1]:
+                yield old[0]
+            old = next(old_links, None)
+            new = next(new_links, None)
+
+
+def sorted_links(links_file):
+    """Reads links file sorted by accession."""
+
+    return external_sort((link.protein_id, link.taxid)
+                         for link in ncbi.protein_taxid_links(links_file))
+
+
+def build_changeset(old_dir, new_dir, out_file, skip_links=False):
+    """Writes change set between two releases.
+
+    Params:
+        old_dir (str): Directory with the old release dump files
+        new_dir (str): Directory with the new release dump files
+        out_file (str): Output change set file
+        skip_links (bool): Compare nodes only. Change set records that links
+                           were not compared.
+
+    Returns:
+        Writes change set file.
+
+    Raises:
+        IOError: if a links file is missing and links are not skipped.
+    """
+
+    old_links = '%s/prot.accession2taxid' % old_dir
+    new_links = '%s/prot.accession2taxid' % new_dir
+
+    if not skip_links:
+        for links_file in (old_links, new_links):
+            if not os.path.exists(links_file):
+                raise IOError('%s doesn\'t exist. Use --skip-links to '
+                              'compare nodes only.' % links_file)
+
+    with open(out_file, 'w') as ofile:
+        for node in diff_nodes(iter_nodes(old_dir), iter_nodes(new_dir)):
+            ofile.write('T\t%s\t%s\n' % (node.taxid, node.scientific_name))
+
+        if skip_links:
+            ofile.write('L\tnot compared\n')
+        else:
+            for protein_acc in diff_links(sorted_links(old_links),
+                                          sorted_links(new_links)):
+                ofile.write('A\t%s\n' % protein_acc)
+
+if __name__ == "__main__":
+    skip_links = '--skip-links' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--skip-links']
+
+    if skip_links:
+        sys.stderr.write('Warning: links are not compared, deflines whose '
+                         'accession points to a different taxid will not '
+                         'be refreshed.\n')
+
+    try:
+        build_changeset(old_dir=args[0], new_dir=args[1], out_file=args[2],
+                        skip_links=skip_links)
+    except IOError as error:
+        sys.exit(str(error))
@@ -3,9 +3,16 @@
 
 from os import sys
 import argparse
+import json
+import threading
+from collections import Counter
 
+from urllib.request import Request, urlopen
+
+import ncbi_taxonomies as ncbi
+from changeset import ChangeSet
+from sortmerge import external_sort, merge_join
 from taxonomydb import TaxDb
-from own_exceptions import  NoRecord, NoProteinLink
 
 usage = """Biological Taxonomies ID Mapper.
 This simple tool allows to map NCBI taxonomy database information onto files
@@ -17,8 +24,59 @@ e.g.:
 
 To run simply type:
 ./mapper.py -i [IN_FILE] -o [OUT_FILE]
+
+If a mapping server (mapperserver.py) is running, point the mapper to it to
+skip connecting to the database and reuse the server's warm caches:
+./mapper.py -i [IN_FILE] -o [OUT_FILE] --server http://localhost:8765
+
+Output formats (-f):
+    lineage - full lineage appended to each defline (default)
+    taxid   - only taxonomy ID appended to each defline, e.g. #| taxid:2 |#
+    tsv     - instead of annotated copy of the input, writes a table of
+              accession, taxid and lineage ID to OUT_FILE and a dictionary
+              of lineage IDs and lineages to OUT_FILE.lineages
+
+Lineages can be limited to selected ranks, written in a fixed-column layout
+with '-' where a lineage has no node of a rank. It requires the shared
+taxonomy (SHARED_TAXONOMY in db.cfg, see sharedtaxonomy.py):
+./mapper.py -i [IN_FILE] -o [OUT_FILE] --ranks superkingdom,phylum,genus
+
+Instead of annotating deflines, mapper can count proteins per clade, with
+counts rolled up to every ancestor, and write the profile as TSV or JSON:
+./mapper.py -i [IN_FILE] -o [OUT_FILE] --profile tsv
+
+For one-off runs against a fresh NCBI release, mapper can work without the
+database. Accessions are sorted externally and merge-joined with the links
+file, lineages are built from nodes and names dump files:
+./mapper.py -i [IN_FILE] -o [OUT_FILE] --links-file prot.accession2taxid \
+            --nodes-file nodes.dmp --names-file names.dmp
+
+Files already annotated by the mapper can be refreshed after a taxonomy
+update. Only deflines affected by a change set (see changeset.py) are
+resolved again, others are copied as they are:
+./mapper.py -i [ANNOTATED_FILE] -o [OUT_FILE] --refresh [CHANGESET_FILE]
 """
 
+OUTPUT_FORMATS = ('lineage', 'taxid', 'tsv')
+PROFILE_FORMATS = ('tsv', 'json')
+
+# Seconds to wait for a mapping server to answer a batch
+SERVER_TIMEOUT = 300
+
+# Placeholder of a rank missing in a lineage
+NO_RANK_NAME = '-'
+
+def parse_ranks(ranks):
+    """Splits comma separated ranks, skipping blank entries.
+
+    e.g.:
+    >>> parse_ranks('superkingdom, ,genus,')
+    ['superkingdom', 'genus']
+    """
+
+    return [rank.strip() for rank in ranks.split(',') if rank.strip()]
+
+
 def parse_arguments(argv):
     """Parses user arguments."""
 
@@ -37,9 +95,139 @@ def parse_arguments(argv):
                         type=str,
                         required=False,
                         default='annotated.txt')
+    parser.add_argument('-s',
+                        '--server',
+                        help='URL of a running mapping server. If specified ' +
+                             'deflines are sent to the server instead of ' +
+                             'querying the database directly',
+                        type=str,
+                        required=False,
+                        default=None)
+    parser.add_argument('-b',
+                        '--batch-size',
+                        help='Number of deflines resolved at once. ' +
+                             'Default is 1000',
+                        type=int,
+                        required=False,
+                        default=1000)
+    parser.add_argument('-f',
+                        '--output-format',
+                        help='Output format, one of: %s. ' %
+                             ', '.join(OUTPUT_FORMATS) +
+                             'Default is \'lineage\'',
+                        type=str,
+                        choices=OUTPUT_FORMATS,
+                        required=False,
+                        default='lineage')
+
+    parser.add_argument('-p',
+                        '--profile',
+                        help='Write taxonomic abundance profile in a given ' +
+                             'format (%s) ' % ', '.join(PROFILE_FORMATS) +
+                             'instead of annotated deflines',
+                        type=str,
+                        choices=PROFILE_FORMATS,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--links-file',
+                        help='NCBI protein accession to taxid links file. ' +
+                             'If specified, mapping is done without the ' +
+                             'database',
+                        type=str,
+                        required=False,
+                        default=None)
+    parser.add_argument('--links-sorted',
+                        help='Links file is already sorted by accession ' +
+                             '(e.g. with LC_ALL=C sort)',
+                        action='store_true')
+    parser.add_argument('--nodes-file',
+                        help='NCBI nodes dump file, required to map ' +
+                             'lineages without the database',
+                        type=str,
+                        required=False,
+                        default=None)
+    parser.add_argument('--names-file',
+                        help='NCBI names dump file, required to map ' +
+                             'lineages without the database',
+                        type=str,
+                        required=False,
+                        default=None)
+    parser.add_argument('--sort-buffer',
+                        help='Number of records sorted in memory before ' +
+                             'spilling to a temporary file. ' +
+                             'Default is 1000000',
+                        type=int,
+                        required=False,
+                        default=1000000)
+    parser.add_argument('--tmp-dir',
+                        help='Directory for temporary files',
+                        type=str,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('-r',
+                        '--refresh',
+                        help='Change set file. If specified, input file ' +
+                             'is an already annotated file and only ' +
+                             'deflines affected by the changes are ' +
+                             'resolved again',
+                        type=str,
+                        required=False,
+                        default=None)
+
+    parser.add_argument('--ranks',
+                        help='Comma separated ranks, e.g. ' +
+                             'superkingdom,phylum,genus. If specified, ' +
+                             'only names at these ranks are written, ' +
+                             'in a fixed-column layout',
+                        type=parse_ranks,
+                        required=False,
+                        default=None)
 
     args = parser.parse_args(argv)
 
+    if args.ranks is not None and not args.ranks:
+        parser.error('--ranks requires at least one rank')
+
+    if args.ranks:
+        for option, value in (('--server', args.server),
+                              ('--profile', args.profile),
+                              ('--links-file', args.links_file)):
+            if value:
+                parser.error('--ranks cannot be combined with %s' % option)
+
+        if args.output_format == 'taxid':
+            parser.error('--ranks cannot be combined with -f taxid, ' +
+                         'which writes no lineages')
+
+    # Rank-only tags leave out unranked nodes, so the change set cannot
+    # tell whether their lineages changed
+    if args.ranks and args.refresh:
+        parser.error('files annotated with --ranks cannot be refreshed, ' +
+                     'map them again instead')
+
+    if args.refresh and (args.server or args.profile or args.links_file or
+                         args.output_format == 'tsv'):
+        parser.error('refresh mode supports only lineage and taxid output ' +
+                     'formats with direct database access')
+
+    if args.links_file:
+        if args.server or args.profile or args.output_format == 'tsv':
+            parser.error('mapping without the database supports only ' +
+                         'lineage and taxid output formats')
+
+        if (args.output_format == 'lineage' and
+                not (args.nodes_file and args.names_file)):
+            parser.error('--nodes-file and --names-file are required to ' +
+                         'map lineages without the database')
+
+    if args.server and args.profile:
+        parser.error('profile mode requires direct database access')
+
+    if args.server and args.output_format == 'tsv':
+        parser.error('tsv output format requires direct database access')
+
     return args
 
 
@@ -64,10 +252,13 @@ def read_protein_acc(defline):
         defline (str): Definition line in FASTA-like format
 
     Returns:
-        protein_acc (str): Protein accession ID
+        protein_acc (str): Protein accession ID, None if defline is empty
     """
 
-    if defline.startswith('gi|'):
+    if not defline.strip():
+        return None
+
+    if defline.startswith('gi|') and defline.count('|') >= 3:
         protein_version = defline.split('|')[3]
         return version_to_accession(protein_version)
 
@@ -79,55 +270,773 @@ def read_protein_acc(defline):
         protein_version = defline.split()[0]
         return version_to_accession(protein_version)
 
-def map_taxonomies(in_file, out_file):
+class LineageCache(object):
+    """Keeps lineages of already resolved taxids in memory, so each of them
+    is retrieved from the database only once.
+
+    If ranks are given, lineages contain only names of ancestors at these
+    ranks, in a fixed order, with NO_RANK_NAME where there is none.
+
+    Cache is emptied when the database switches to a newly published shared
+    taxonomy.
+
+    """
+
+    def __init__(self, database, max_size=100000, ranks=None):
+        self.database = database
+        self.max_size = max_size
+        self.ranks = ranks
+        self._lineages = {}
+        self._version = database.taxonomy_version
+        self._lock = threading.Lock()
+
+    def get(self, taxid):
+        """Returns lineage of a taxid.
+
+        Params:
+            taxid (str): Taxonomy ID
+
+        Returns:
+            lineage (list): Lineage of the taxid, empty if the taxid
+                            doesn't exist in the database.
+        """
+
+        version = self.database.taxonomy_version
+        if version != self._version:
+            with self._lock:
+                self._lineages.clear()
+                self._version = version
+
+        lineage = self._lineages.get(taxid)
+
+        if lineage is None:
+            if self.ranks:
+                names = self.database.find_rank_lineage(taxid, self.ranks)
+                lineage = [name or NO_RANK_NAME
+                           for name in names] if names else []
+            else:
+                lineage = self.database.find_lineage(taxid) or []
+
+            with self._lock:
+                # Simply start over when the cache is full
+                if len(self._lineages) >= self.max_size:
+                    self._lineages.clear()
+
+                # Lineage read from a version replaced in the meantime
+                # is not kept
+                if version == self._version:
+                    self._lineages[taxid] = lineage
+
+        return lineage
+
+
+def tag_defline(defline, lineage):
+    """Appends lineage to a definition line.
+
+    Params:
+        defline (str): Definition line in FASTA-like format
+        lineage (list): Lineage of an organism
+
+    Returns:
+        new_defline (str): Definition line with lineage between '#|' and '|#'
+
+    e.g.:
+    >>> tag_defline('>P1 protein\\n', ['cellular organisms', 'Bacteria'])
+    '>P1 protein #| cellular organisms<->Bacteria |#\\n'
+    """
+
+    return '%s #| %s |#\n' % (defline.strip(), '<->'.join(lineage))
+
+
+def tag_taxid(defline, taxid):
+    """Appends taxonomy ID to a definition line.
+
+    Params:
+        defline (str): Definition line in FASTA-like format
+        taxid (str): Taxonomy ID
+
+    Returns:
+        new_defline (str): Definition line with taxid between '#|' and '|#'
+
+    e.g.:
+    >>> tag_taxid('>P1 protein\\n', '2')
+    '>P1 protein #| taxid:2 |#\\n'
+    """
+
+    return '%s #| taxid:%s |#\n' % (defline.strip(), taxid)
+
+
+class LineageDictionary(object):
+    """Assigns consecutive IDs to lineages and writes each new lineage to
+    a dictionary file, so every lineage is written only once.
+
+    Full lineages are unique for each taxid, so they are looked up by taxid.
+    Lineages limited to selected ranks are shared by many taxids and are
+    looked up by their content instead.
+
+    """
+
+    def __init__(self, handle, separator='<->', by_lineage=False):
+        self.handle = handle
+        self.separator = separator
+        self.by_lineage = by_lineage
+        self._ids = {}
+
+    def get_id(self, taxid, lineage):
+        """Returns ID of the lineage of a taxid.
+
+        Params:
+            taxid (str): Taxonomy ID
+            lineage (list): Lineage of the taxid
+
+        Returns:
+            lineage_id (int): Lineage ID
+        """
+
+        key = tuple(lineage) if self.by_lineage else taxid
+        lineage_id = self._ids.get(key)
+
+        if lineage_id is None:
+            lineage_id = len(self._ids) + 1
+            self._ids[key] = lineage_id
+            self.handle.write('%d\t%s\n'
+                              % (lineage_id, self.separator.join(lineage)))
+
+        return lineage_id
+
+
+def resolve_accessions(accessions, database, cache=None):
+    """Resolves taxids and lineages for a batch of protein accessions.
+
+    Params:
+        accessions (list): Protein accessions
+        database (TaxDb): Connection to the database
+        cache (LineageCache): Cache of already resolved lineages. If not
+                              given, lineages are not resolved.
+
+    Returns:
+        resolved (list): (taxid, lineage) tuple for each accession. Taxid is
+                         None if accession cannot be mapped, lineage is None
+                         if it cannot be mapped or was not resolved.
+    """
+
+    # Empty deflines have no accession to look up
+    queried = [protein_acc for protein_acc in accessions if protein_acc]
+    found = dict(zip(queried,
+                     database.fill_taxids(queried, [None] * len(queried))))
+    taxids = [found.get(protein_acc) for protein_acc in accessions]
+
+    resolved = []
+    for taxid in taxids:
+        if taxid and cache:
+            lineage = cache.get(taxid) or None
+        else:
+            lineage = None
+
+        resolved.append((taxid, lineage))
+
+    return resolved
+
+
+def accession_lineages(accessions, database, cache):
+    """Resolves lineages for a batch of protein accessions.
+
+    Params:
+        accessions (list): Protein accessions
+        database (TaxDb): Connection to the database
+        cache (LineageCache): Cache of already resolved lineages
+
+    Returns:
+        lineages (dict): {accession: lineage} pairs, lineage is None if
+                         accession cannot be mapped.
+    """
+
+    resolved = resolve_accessions(accessions, database, cache)
+
+    return dict((protein_acc, lineage)
+                for protein_acc, (_, lineage) in zip(accessions, resolved))
+
+
+def annotate_deflines(deflines, database, cache, output_format='lineage'):
+    """Maps taxonomies onto a batch of deflines.
+
+    Params:
+        deflines (list): Definition lines, each starting with '>'
+        database (TaxDb): Connection to the database
+        cache (LineageCache): Cache of already resolved lineages
+        output_format (str): Either 'lineage' or 'taxid'
+
+    Returns:
+        annotated (list): Deflines with lineages or taxids appended. Deflines
+                          which cannot be mapped, including empty ones, are
+                          returned as they are.
+    """
+
+    accessions = [read_protein_acc(defline[1:]) for defline in deflines]
+
+    if output_format == 'taxid':
+        resolved = resolve_accessions(accessions, database)
+    else:
+        resolved = resolve_accessions(accessions, database, cache)
+
+    annotated = []
+    for defline, (taxid, lineage) in zip(deflines, resolved):
+        if output_format == 'taxid' and taxid:
+            annotated.append(tag_taxid(defline, taxid))
+        elif lineage:
+            annotated.append(tag_defline(defline, lineage))
+        else:
+            annotated.append(defline)
+
+    return annotated
+
+
+def write_table(chunks, ofile, lfile, database, cache, separator='<->'):
+    """Writes accession, taxid and lineage ID table with a separate lineage
+    dictionary.
+
+    Params:
+        chunks (iterable): Chunks of lines read from the input file
+        ofile (file): Output table file
+        lfile (file): Output lineage dictionary file
+        database (TaxDb): Connection to the database
+        cache (LineageCache): Cache of already resolved lineages
+        separator (str): Separator of lineage nodes in the dictionary
+
+    Returns:
+        Writes tab separated rows of mapped accessions to the output table and
+        new lineages to the dictionary. Lineage ID is empty if lineage of
+        a taxid cannot be resolved.
+    """
+
+    dictionary = LineageDictionary(lfile, separator,
+                                   by_lineage=bool(cache.ranks))
+
+    for chunk in chunks:
+        accessions = [read_protein_acc(line[1:]) for line in chunk
+                      if line.startswith('>')]
+        resolved = resolve_accessions(accessions, database, cache)
+
+        for protein_acc, (taxid, lineage) in zip(accessions, resolved):
+            if not taxid:
+                continue
+
+            # Taxid is kept even if its lineage cannot be resolved
+            lineage_id = dictionary.get_id(taxid, lineage) if lineage else ''
+            ofile.write('%s\t%s\t%s\n' % (protein_acc, taxid, lineage_id))
+
+
+def read_chunks(handle, batch_size):
+    """Reads file in chunks containing at most batch_size deflines.
+
+    Params:
+        handle (file): Opened input file
+        batch_size (int): Maximal number of deflines in a chunk
+
+    Returns:
+        Generator yielding lists of lines.
+    """
+
+    chunk = []
+    deflines = 0
+
+    for line in handle:
+        chunk.append(line)
+
+        if line.startswith('>'):
+            deflines += 1
+
+            if deflines == batch_size:
+                yield chunk
+                chunk = []
+                deflines = 0
+
+    if chunk:
+        yield chunk
+
+
+def annotate_chunk(lines, annotate):
+    """Replaces deflines in a chunk of lines with annotated ones.
+
+    Params:
+        lines (list): Lines read from the input file
+        annotate (function): Function annotating a list of deflines
+
+    Returns:
+        lines (list): Lines with annotated deflines
+    """
+
+    positions = [i for i, line in enumerate(lines) if line.startswith('>')]
+
+    if positions:
+        annotated = annotate([lines[i] for i in positions])
+
+        for i, new_defline in zip(positions, annotated):
+            lines[i] = new_defline
+
+    return lines
+
+
+def query_server(server_url, path, payload, timeout=SERVER_TIMEOUT):
+    """Sends JSON request to a mapping server.
+
+    Params:
+        server_url (str): URL of the server, e.g. http://localhost:8765
+        path (str): Endpoint, '/deflines' or '/lineages'
+        payload (dict): Request body
+        timeout (float): Seconds to wait for the server
+
+    Returns:
+        response (dict): Decoded server response
+    """
+
+    request = Request(server_url.rstrip('/') + path,
+                      data=json.dumps(payload).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+
+    response = urlopen(request, timeout=timeout)
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
+
+
+def map_taxonomies(in_file, out_file, batch_size=1000,
+                   output_format='lineage', ranks=None):
     """Maps taxonomies onto deflines from input file.
     Params:
         in_file (str): Input filename
         out_file (str): Output filename
+        batch_size (int): Number of deflines resolved with a single query
+        output_format (str): One of OUTPUT_FORMATS
+        ranks (list): Ranks written instead of full lineages. Requires
+                      shared taxonomy.
 
     Returns:
         Writes output file, as specified in input parameters, with taxonomy
         markings.
+
+    Raises:
+        ValueError: if ranks are given, but shared taxonomy is not set.
     """
 
     # Connect to the database
     database = TaxDb()
 
-    # Open input and output files for reading / writing
+    # Only the shared taxonomy has precomputed ancestors at ranks, the
+    # database would be queried once per level of the tree for every taxid
+    if ranks and not database.shared_taxonomy:
+        database.disconnect()
+        raise ValueError('--ranks requires SHARED_TAXONOMY in the database ' +
+                         'configuration file')
+
+    cache = LineageCache(database, ranks=ranks)
+
+    def annotate(deflines):
+        return annotate_deflines(deflines, database, cache, output_format)
+
+    # Open input and output files for reading / writing. Deflines are
+    # resolved in batches, other lines are written to output as they are
     with open(in_file, 'r') as ifile, open(out_file, 'w') as ofile:
-        # Iterate in line per line fashion
+        if output_format == 'tsv':
+            with open('%s.lineages' % out_file, 'w') as lfile:
+                # Ranks are kept in separate columns of the dictionary
+                write_table(read_chunks(ifile, batch_size),
+                            ofile, lfile, database, cache,
+                            '\t' if ranks else '<->')
+        else:
+            for chunk in read_chunks(ifile, batch_size):
+                ofile.writelines(annotate_chunk(chunk, annotate))
+
+    # Just in case - disconnect from the database
+    database.disconnect()
+
+
+def map_taxonomies_remote(in_file, out_file, server_url, batch_size=1000,
+                          output_format='lineage'):
+    """Maps taxonomies onto deflines using a running mapping server.
+
+    Params:
+        in_file (str): Input filename
+        out_file (str): Output filename
+        server_url (str): URL of the mapping server
+        batch_size (int): Number of deflines sent in a single request
+        output_format (str): Either 'lineage' or 'taxid'
+
+    Returns:
+        Writes output file, as specified in input parameters, with taxonomy
+        markings.
+    """
+
+    def annotate(deflines):
+        response = query_server(server_url, '/deflines',
+                                {'deflines': deflines,
+                                 'format': output_format})
+        return response['deflines']
+
+    with open(in_file, 'r') as ifile, open(out_file, 'w') as ofile:
+        for chunk in read_chunks(ifile, batch_size):
+            ofile.writelines(annotate_chunk(chunk, annotate))
+
+def split_tag(defline):
+    """Splits annotated definition line into the defline and its tag.
+
+    Params:
+        defline (str): Definition line, possibly annotated by the mapper
+
+    Returns:
+        defline (str): Definition line without the tag
+        tag (str): Tag content, None if defline was not annotated
+
+    e.g.:
+    >>> split_tag('>P1 protein #| cellular organisms<->Bacteria |#\\n')
+    ('>P1 protein\\n', 'cellular organisms<->Bacteria')
+    >>> split_tag('>P1 protein\\n')
+    ('>P1 protein\\n', None)
+    """
+
+    stripped = defline.rstrip('\n')
+    start = stripped.rfind(' #| ')
+
+    if start < 0 or not stripped.endswith(' |#'):
+        return defline, None
+
+    return stripped[:start] + '\n', stripped[start + 4:-3]
+
+
+def needs_refresh(protein_acc, tag, changes):
+    """Checks whether annotation of a defline may have changed.
+
+    Params:
+        protein_acc (str): Protein accession
+        tag (str): Tag content, None if defline was not annotated
+        changes (ChangeSet): Changes between releases
+
+    Returns:
+        changed (bool): Whether defline has to be resolved again
+    """
+
+    if protein_acc in changes.accessions:
+        return True
+
+    # Accession not mapped before and its link didn't change
+    if tag is None:
+        return False
+
+    if tag.startswith('taxid:'):
+        return tag[len('taxid:'):] in changes.taxids
+
+    return changes.lineage_changed(tag.split('<->'))
+
+
+def refresh_taxonomies(in_file, out_file, changeset_file, batch_size=1000,
+                       output_format='lineage'):
+    """Refreshes taxonomies in an already annotated file.
+
+    Deflines not affected by the change set are copied as they are, without
+    database access. Connection to the database is opened only if any
+    defline has to be resolved again. Resolved deflines keep the format of
+    their tag, so a file never mixes lineage and taxid tags.
+
+    Params:
+        in_file (str): Input filename, annotated by the mapper
+        out_file (str): Output filename
+        changeset_file (str): Change set between releases
+        batch_size (int): Number of deflines in a chunk
+        output_format (str): Either 'lineage' or 'taxid', used for deflines
+                             which were not annotated before
+
+    Returns:
+        Writes output file with refreshed taxonomy markings.
+    """
+
+    changes = ChangeSet.read(changeset_file)
+    database = None
+
+    if not changes.links_compared:
+        sys.stderr.write('Warning: links were not compared in %s, deflines '
+                         'whose accession points to a different taxid are '
+                         'not refreshed.\n' % changeset_file)
+
+    with open(in_file, 'r') as ifile, open(out_file, 'w') as ofile:
+        for chunk in read_chunks(ifile, batch_size):
+            # Positions of deflines to resolve again, by their tag format
+            positions = {'lineage': [], 'taxid': []}
+
+            for i, line in enumerate(chunk):
+                if not line.startswith('>'):
+                    continue
+
+                defline, tag = split_tag(line)
+
+                if needs_refresh(read_protein_acc(defline[1:]), tag, changes):
+                    if tag is None:
+                        tag_format = output_format
+                    elif tag.startswith('taxid:'):
+                        tag_format = 'taxid'
+                    else:
+                        tag_format = 'lineage'
+
+                    chunk[i] = defline
+                    positions[tag_format].append(i)
+
+            for tag_format, stale in positions.items():
+                if not stale:
+                    continue
+
+                if database is None:
+                    database = TaxDb()
+                    cache = LineageCache(database)
+
+                annotated = annotate_deflines([chunk[i] for i in stale],
+                                              database, cache, tag_format)
+
+                for i, new_defline in zip(stale, annotated):
+                    chunk[i] = new_defline
+
+            ofile.writelines(chunk)
+
+    if database is not None:
+        database.disconnect()
+
+
+def map_taxonomies_offline(in_file, out_file, links_file, nodes_file=None,
+                           names_file=None, output_format='lineage',
+                           links_sorted=False, buffer_size=1000000,
+                           tmp_dir=None):
+    """Maps taxonomies onto deflines without the database.
+
+    Accessions are extracted from the input file and sorted externally, then
+    merge-joined in a single pass with the links file. Matching taxids are
+    sorted back into the input order and written while the input file is
+    read for the second time.
+
+    Params:
+        in_file (str): Input filename
+        out_file (str): Output filename
+        links_file (str): NCBI protein accession to taxid links file
+        nodes_file (str): NCBI nodes dump file
+        names_file (str): NCBI names dump file
+        output_format (str): Either 'lineage' or 'taxid'
+        links_sorted (bool): Whether the links file is sorted by accession
+        buffer_size (int): Number of records sorted in memory at once
+        tmp_dir (str): Directory for temporary files
+
+    Returns:
+        Writes output file, as specified in input parameters, with taxonomy
+        markings.
+    """
+
+    def queries():
+        """Yields accession and position of each defline."""
+        with open(in_file, 'r') as ifile:
+            position = 0
+            for line in ifile:
+                if line.startswith('>'):
+                    protein_acc = read_protein_acc(line[1:])
+                    if protein_acc:
+                        yield protein_acc, str(position)
+                    position += 1
+
+    links = ((link.protein_id, link.taxid)
+             for link in ncbi.protein_taxid_links(links_file))
+
+    if not links_sorted:
+        links = external_sort(links, buffer_size=buffer_size, tmp_dir=tmp_dir)
+
+    matches = merge_join(external_sort(queries(), buffer_size=buffer_size,
+                                       tmp_dir=tmp_dir),
+                         links)
+
+    # (position, taxid) pairs back in the input order
+    taxids = external_sort(matches, key=lambda match: int(match[0]),
+                           buffer_size=buffer_size, tmp_dir=tmp_dir)
+
+    if output_format == 'lineage':
+        parents = ncbi.read_nodes_dump(nodes_file)
+        names = ncbi.read_names_dump(names_file)
+        lineages = {}
+
+    match = next(taxids, None)
+
+    with open(in_file, 'r') as ifile, open(out_file, 'w') as ofile:
+        position = 0
+
         for line in ifile:
-            # If it is not defline - write to putput as it is
             if not line.startswith('>'):
                 ofile.write(line)
                 continue
 
-            # Retrieve data from the database
-            protein_acc = read_protein_acc(line[1:])
+            if match is not None and int(match[0]) == position:
+                taxid = match[1]
+                match = next(taxids, None)
 
-            # Catch exceptions notifying about non-existing entries in
-            # the database. In such case there should be no mapping
-            # and defline should be written to output as it is
-            try:
-                taxid = database.protein_taxid(protein_acc)
-                lineage = database.get_lineage_from_db(taxid)
+                if output_format == 'taxid':
+                    line = tag_taxid(line, taxid)
+                else:
+                    if taxid not in lineages:
+                        lineages[taxid] = ncbi.build_lineage(taxid, parents,
+                                                             names)
+                    if lineages[taxid]:
+                        line = tag_defline(line, lineages[taxid])
 
-            except (NoRecord, NoProteinLink) as e:
-                ofile.write(line)
-                continue
+            ofile.write(line)
+            position += 1
 
-            # Create lineage string in a human-readable way
-            lineage = "<->".join(lineage)
 
-            # Create new definition line containing lineage
-            new_defline = '%s #| %s |#\n' % (line.strip(),
-                                             lineage)
-            # Write to output
-            ofile.write(new_defline)
+def rollup_counts(counts, parents):
+    """Rolls counts up along the taxonomy tree.
+
+    Nodes are ordered from the deepest one, so a single pass adding each
+    node's cumulative count to its parent is enough.
+
+    Params:
+        counts (dict): {taxid: count} pairs of direct hits
+        parents (dict): {taxid: parent_taxid} pairs of the tree
+
+    Returns:
+        cumulative (dict): {taxid: count} pairs, including hits of all
+                           descendants
+
+    e.g.:
+    >>> parents = {'1': '1', '2': '1', '6': '2', '7': '6', '9': '2'}
+    >>> cumulative = rollup_counts({'7': 3, '9': 1, '2': 1}, parents)
+    >>> sorted(cumulative.items())
+    [('1', 5), ('2', 5), ('6', 3), ('7', 3), ('9', 1)]
+    """
+
+    depths = {}
+
+    for taxid in parents:
+        path = []
+        current = taxid
+
+        # Walk up until a node of known depth, a root or a cycle is reached.
+        # Placeholder depth protects against cycles.
+        while current in parents and current not in depths:
+            depths[current] = -1
+            path.append(current)
+            current = parents[current]
+
+        depth = depths.get(current, -1) + 1
+        for node in reversed(path):
+            depths[node] = depth
+            depth += 1
+
+    cumulative = dict((taxid, 0) for taxid in parents)
+    cumulative.update(counts)
+
+    for taxid in sorted(parents, key=depths.get, reverse=True):
+        parent = parents[taxid]
+
+        if parent != taxid and parent in cumulative:
+            cumulative[parent] += cumulative[taxid]
+
+    return cumulative
+
+
+def write_profile(handle, counts, cumulative, nodes, deflines, unmapped,
+                  profile_format='tsv'):
+    """Writes taxonomic abundance profile.
+
+    Params:
+        handle (file): Output file
+        counts (dict): {taxid: count} pairs of direct hits
+        cumulative (dict): {taxid: count} pairs including descendants' hits
+        nodes (dict): {taxid: Node} pairs
+        deflines (int): Number of deflines in the input
+        unmapped (int): Number of deflines which could not be mapped
+        profile_format (str): One of PROFILE_FORMATS
+
+    Returns:
+        Writes clades ordered by decreasing cumulative count.
+    """
+
+    clades = []
+    for taxid in sorted(cumulative, key=lambda t: (-cumulative[t], t)):
+        node = nodes.get(taxid)
+        clades.append({'taxid': taxid,
+                       'parent': node.upper_hierarchy if node else None,
+                       'name': node.scientific_name if node else None,
+                       'count': counts.get(taxid, 0),
+                       'cumulative': cumulative[taxid]})
+
+    if profile_format == 'json':
+        json.dump({'deflines': deflines,
+                   'unmapped': unmapped,
+                   'clades': clades}, handle, indent=1)
+        return
+
+    handle.write('# deflines: %d, unmapped: %d\n' % (deflines, unmapped))
+    handle.write('taxid\tparent\tname\tcount\tcumulative\n')
+    for clade in clades:
+        handle.write('%s\t%s\t%s\t%d\t%d\n'
+                     % (clade['taxid'], clade['parent'] or '',
+                        clade['name'] or '', clade['count'],
+                        clade['cumulative']))
+
+
+def profile_taxonomies(in_file, out_file, batch_size=1000,
+                       profile_format='tsv'):
+    """Counts proteins from input file per clade.
+
+    Params:
+        in_file (str): Input filename
+        out_file (str): Output filename
+        batch_size (int): Number of deflines resolved with a single query
+        profile_format (str): One of PROFILE_FORMATS
+
+    Returns:
+        Writes output file with taxonomic abundance profile.
+    """
+
+    database = TaxDb()
+
+    counts = Counter()
+    deflines = 0
+
+    # Resolve taxids of deflines in batches and count hits
+    with open(in_file, 'r') as ifile:
+        for chunk in read_chunks(ifile, batch_size):
+            accessions = [read_protein_acc(line[1:]) for line in chunk
+                          if line.startswith('>')]
+            taxids = database.protein_taxids(set(protein_acc for protein_acc
+                                                 in accessions if protein_acc))
+
+            deflines += len(accessions)
+            counts.update(taxids[protein_acc] for protein_acc in accessions
+                          if protein_acc in taxids)
+
+    # Retrieve parent structure of all hits and roll counts up
+    nodes = database.get_ancestors(counts)
+    parents = dict((taxid, node.upper_hierarchy)
+                   for taxid, node in nodes.items())
+    cumulative = rollup_counts(counts, parents)
 
-    # Just in case - disconnect from the database
     database.disconnect()
 
+    with open(out_file, 'w') as ofile:
+        write_profile(ofile, counts, cumulative, nodes, deflines,
+                      deflines - sum(counts.values()), profile_format)
+
 if __name__ == '__main__':
     args = parse_arguments(sys.argv[1:])
-    map_taxonomies(args.input_file, args.output_file)
+
+    if args.refresh:
+        refresh_taxonomies(args.input_file, args.output_file, args.refresh,
+                           args.batch_size, args.output_format)
+    elif args.links_file:
+        map_taxonomies_offline(args.input_file, args.output_file,
+                               args.links_file, args.nodes_file,
+                               args.names_file, args.output_format,
+                               args.links_sorted, args.sort_buffer,
+                               args.tmp_dir)
+    elif args.profile:
+        profile_taxonomies(args.input_file, args.output_file, args.batch_size,
+                           args.profile)
+    elif args.server:
+        map_taxonomies_remote(args.input_file, args.output_file,
+                              args.server, args.batch_size, args.output_format)
+    else:
+        map_taxonomies(args.input_file, args.output_file, args.batch_size,
+                       args.output_format, args.ranks)
@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+"""Resident mapping server for the BioTaxIDMapper package.
+
+Server keeps a single connection to the local taxonomy database and a cache
+of already resolved lineages, so mapping many small files does not pay for
+interpreter start-up, new connection and cold caches every time.
+
+Endpoints (POST, JSON body):
+    /deflines   {"deflines": [">P1 ...", ...], "format": "lineage"}
+                returns {"deflines": [">P1 ... #| ... |#", ...]}
+                format is optional, either "lineage" (default) or "taxid"
+    /lineages   {"accessions": ["P1", ...]}
+                returns {"lineages": {"P1": ["cellular organisms", ...]}}
+
+To run simply type:
+./mapperserver.py --port 8765
+"""
+
+from os import sys
+import argparse
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from taxonomydb import TaxDb
+from mapper import LineageCache, accession_lineages, annotate_deflines
+
+
+def parse_arguments(argv):
+    """Parses user arguments."""
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--host',
+                        help='Address to listen on. Default is localhost',
+                        type=str,
+                        default='localhost')
+    parser.add_argument('-p',
+                        '--port',
+                        help='Port to listen on. Default is 8765',
+                        type=int,
+                        default=8765)
+    parser.add_argument('-c',
+                        '--cfg-file',
+                        help='Database configuration file. ' +
+                             'Default is db.cfg from the package directory',
+                        type=str,
+                        default=None)
+    parser.add_argument('-b',
+                        '--batch-size',
+                        help='Number of deflines resolved with a single ' +
+                             'query. Default is 1000',
+                        type=int,
+                        default=1000)
+    parser.add_argument('-w',
+                        '--max-concurrent',
+                        help='Number of batches resolved concurrently. ' +
+                             'Default is 4',
+                        type=int,
+                        default=4)
+    parser.add_argument('--cache-size',
+                        help='Number of lineages kept in memory. ' +
+                             'Default is 100000',
+                        type=int,
+                        default=100000)
+
+    return parser.parse_args(argv)
+
+
+class MappingServer(ThreadingMixIn, HTTPServer):
+    """HTTP server holding database connection and lineage cache shared by
+    all requests.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, database, batch_size=1000, max_concurrent=4,
+                 cache_size=100000):
+        HTTPServer.__init__(self, address, MappingRequestHandler)
+
+        self.database = database
+        self.cache = LineageCache(database, max_size=cache_size)
+        self.batch_size = batch_size
+
+        # Limits number of batches hitting the database at the same time,
+        # remaining requests wait for a free slot
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+
+    def batches(self, items):
+        """Splits list of items into batches of batch_size."""
+
+        for start in range(0, len(items), self.batch_size):
+            yield items[start:start + self.batch_size]
+
+    def annotate(self, deflines, output_format='lineage'):
+        """Maps taxonomies onto a list of deflines."""
+
+        annotated = []
+        for batch in self.batches(deflines):
+            with self.slots:
+                annotated.extend(
+                    annotate_deflines(batch, self.database, self.cache,
+                                      output_format))
+
+        return annotated
+
+    def lineages(self, accessions):
+        """Resolves lineages of a list of protein accessions."""
+
+        lineages = {}
+        for batch in self.batches(accessions):
+            with self.slots:
+                lineages.update(
+                    accession_lineages(batch, self.database, self.cache))
+
+        return lineages
+
+
+def read_strings(payload, field):
+    """Reads a list of strings from a request body.
+
+    Params:
+        payload (dict): Decoded request body
+        field (str): Name of the field
+
+    Returns:
+        items (list): List of strings
+
+    Raises:
+        ValueError: if the field is not a list of strings.
+
+    e.g.:
+    >>> read_strings({'deflines': ['>P1']}, 'deflines')
+    ['>P1']
+    >>> read_strings({'deflines': 'abc'}, 'deflines')
+    Traceback (most recent call last):
+    ...
+    ValueError: deflines has to be a list of strings
+    """
+
+    items = payload[field]
+
+    if (not isinstance(items, list) or
+            not all(isinstance(item, str) for item in items)):
+        raise ValueError('%s has to be a list of strings' % field)
+
+    return items
+
+
+class MappingRequestHandler(BaseHTTPRequestHandler):
+    """Handles requests sent to the MappingServer."""
+
+    def do_POST(self):
+        """Dispatches request to a proper endpoint."""
+
+        if self.path not in ('/deflines', '/lineages'):
+            self.send_error(404, 'Unknown endpoint %s' % self.path)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length).decode('utf-8'))
+
+            if self.path == '/deflines':
+                output_format = payload.get('format', 'lineage')
+                if output_format not in ('lineage', 'taxid'):
+                    raise ValueError(output_format)
+
+                items = read_strings(payload, 'deflines')
+            else:
+                items = read_strings(payload, 'accessions')
+
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send_error(400, 'Malformed request')
+            return
+
+        try:
+            if self.path == '/deflines':
+                body = {'deflines': self.server.annotate(items,
+                                                         output_format)}
+            else:
+                body = {'lineages': self.server.lineages(items)}
+
+        # Database errors and bugs must not leave the client without
+        # a response
+        except Exception as error:
+            self.log_error('Failed to handle %s: %r', self.path, error)
+            self.send_error(500, 'Internal server error')
+            return
+
+        data = json.dumps(body).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+
+    database = TaxDb(args.cfg_file)
+    server = MappingServer((args.host, args.port),
+                           database,
+                           batch_size=args.batch_size,
+                           max_concurrent=args.max_concurrent,
+                           cache_size=args.cache_size)
+
+    print('Serving on http://%s:%d' % (args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        database.disconnect()
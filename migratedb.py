@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Script migrating local taxonomy database between storage schemas.
+
+Script copies nodes and protein links from one database into another, which
+may use different storage schema. Schema is set with the 'SCHEMA' parameter
+of a database configuration file:
+    legacy  - string taxids and accessions, default
+    compact - integer taxids, short field names and accessions split into
+              a prefix dictionary and a number, used as document's _id
+
+Requirements:
+    Source config - configuration file of a database to read from.
+    Target config - configuration file of a database to write to. Target
+                    database should use a different name than the source one.
+
+To run simply type:
+python migratedb.py [SOURCE_CFG] [TARGET_CFG]
+"""
+
+# External libraries imports
+from os import sys
+
+# Internal modules import
+from taxonomydb import TaxDb
+
+# Number of documents written to the target database at once
+BATCH_SIZE = 10000
+
+
+def copy_in_batches(records, insert, batch_size=BATCH_SIZE):
+    """Writes records in batches.
+
+    Params:
+        records (iterable): Records to write
+        insert (function): Function inserting a list of records
+        batch_size (int): Number of records written at once
+
+    Returns:
+        copied (int): Number of inserted records
+    """
+
+    copied = 0
+    batch = []
+
+    for record in records:
+        batch.append(record)
+
+        if len(batch) == batch_size:
+            copied += insert(batch)
+            batch = []
+
+    copied += insert(batch)
+
+    return copied
+
+
+def migrate(source_cfg, target_cfg):
+    """Copies all nodes and links from source to target database."""
+
+    source = TaxDb(source_cfg)
+    target = TaxDb(target_cfg)
+
+    print('Migrating %s (%s) into %s (%s)...' % (source.NAME, source.SCHEMA,
+                                                target.NAME, target.SCHEMA))
+
+    print('Copying nodes...')
+    copied = copy_in_batches(source.iter_nodes(), target.add_records)
+    print('%d nodes copied.' % copied)
+
+    print('Copying links...')
+    copied = copy_in_batches(source.iter_protein_links(),
+                             target.add_protein_links)
+    print('%d links copied.' % copied)
+
+    # Compact schema uses _id for lookups by taxid and accession, only
+    # searching by scientific name requires an additional index
+    if target.compact:
+        target.db_nodes.create_index('n')
+    else:
+        target.db_nodes.create_index('TaxID', unique=True)
+        target.db_links.create_index('ProteinID', unique=True)
+
+    source.disconnect()
+    target.disconnect()
+
+    print('Done!')
+
+if __name__ == "__main__":
+    migrate(source_cfg=sys.argv[1], target_cfg=sys.argv[2])
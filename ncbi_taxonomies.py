@@ -1,7 +1,26 @@
 """NCBI Taxonomies read NCBI's taxonomy dumps"""
 
-from own_exceptions import DoubleRelies
-from own_objects import ProteinLink
+from own_exceptions import DoubleRelies, MissingParent, NoRecord
+from own_objects import Node, ProteinLink
+
+
+def iter_names_dump(file_path):
+    """Iterates over scientific names in a dump file.
+
+    Params:
+        file_path (str): Path to a name dmp file.
+
+    Returns:
+        Generator yielding (taxid, name) pairs in the file order.
+    """
+
+    with open(file_path, 'r') as in_file:
+        for node in in_file:
+            node = node.split('\t|\t')
+            status = node[3].split('\t|')[0].strip()
+
+            if status == 'scientific name':
+                yield node[0], node[1]
 
 def read_names_dump(file_path):
     """Reads names from a dump file.
@@ -15,17 +34,28 @@ def read_names_dump(file_path):
 
     names = {}
 
+    for taxid, name in iter_names_dump(file_path):
+        if taxid not in names:
+            names[taxid] = name
+
+    return names
+
+def iter_nodes_dump(file_path):
+    """Iterates over nodes in a dump file, including the highest hierarchy
+    nodes pointing to themselves.
+
+    Params:
+        file_path (str): Path to a nodes dmp file.
+
+    Returns:
+        Generator yielding (taxid, parent_taxid, rank) tuples in the file
+        order.
+    """
+
     with open(file_path, 'r') as in_file:
         for node in in_file:
             node = node.split('\t|\t')
-            taxid = node[0]
-            name = node[1]
-            status = node[3].split('\t|')[0].strip()
-
-            if taxid not in names and status == 'scientific name':
-                names[taxid] = name
-
-    return names
+            yield node[0], node[1], node[2]
 
 def read_nodes_dump(file_path):
     """Reads node from a dump file.
@@ -48,23 +78,224 @@ def read_nodes_dump(file_path):
 
     relies = {}
 
-    with open(file_path, 'r') as in_file:
-        for node in in_file:
-            node = node.split('\t|\t')
-            taxid = node[0]
-            parent_taxid = node[1]
-
-            # Do not take highest hierarchy nodes
-            if taxid == parent_taxid:
-                continue
+    for taxid, parent_taxid, _ in iter_nodes_dump(file_path):
+        # Do not take highest hierarchy nodes
+        if taxid == parent_taxid:
+            continue
 
-            if taxid not in relies:
-                relies[taxid] = parent_taxid
-            else:
-                raise DoubleRelies(taxid=taxid, parent_taxid=parent_taxid)
+        if taxid not in relies:
+            relies[taxid] = parent_taxid
+        else:
+            raise DoubleRelies(taxid=taxid, parent_taxid=parent_taxid)
 
     return relies
 
+def build_lineage(taxid, parents, names):
+    """Builds lineage from in-memory maps read from dump files.
+
+    Params:
+        taxid (str): Taxonomy ID
+        parents (dict): {taxid: parent_taxid} pairs, as from read_nodes_dump
+        names (dict): {taxid: name} pairs, as from read_names_dump
+
+    Returns:
+        lineage (list): Lineage from the highest hierarchy node down to the
+                        taxid, None if taxid doesn't exist.
+
+    Raises:
+        NoRecord: if there is no scientific name for a node of the lineage.
+
+    e.g.:
+    >>> parents = {'2': '131567', '131567': '1'}
+    >>> names = {'1': 'root', '2': 'Bacteria', '131567': 'cellular organisms'}
+    >>> build_lineage('2', parents, names)
+    ['cellular organisms', 'Bacteria']
+    """
+
+    if taxid not in parents:
+        return None
+
+    lineage = []
+    visited = set()
+
+    # Highest hierarchy nodes are not in parents, walk stops below them.
+    # Visited nodes protect against cycles.
+    while taxid in parents and taxid not in visited:
+        if taxid not in names:
+            raise NoRecord(taxid)
+
+        visited.add(taxid)
+        lineage.append(names[taxid])
+        taxid = parents[taxid]
+
+    lineage.reverse()
+    return lineage
+
+class TaxidBitmap(object):
+    """Set of integer taxids kept as a bitmap, one bit per taxid.
+
+    e.g.:
+    >>> bitmap = TaxidBitmap()
+    >>> bitmap.add(2)
+    >>> bitmap.add(9)
+    >>> 9 in bitmap, 3 in bitmap
+    (True, False)
+    >>> other = TaxidBitmap()
+    >>> other.add(2)
+    >>> list(bitmap.difference(other))
+    [9]
+
+    """
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, taxid):
+        """Adds taxid to the set."""
+
+        byte, bit = divmod(taxid, 8)
+
+        if byte >= len(self.bits):
+            # Grow at least twice to avoid frequent reallocations
+            self.bits.extend(bytearray(max(byte + 1, 2 * len(self.bits))
+                                       - len(self.bits)))
+
+        self.bits[byte] |= 1 << bit
+
+    def __contains__(self, taxid):
+        byte, bit = divmod(taxid, 8)
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << bit))
+
+    def difference(self, other):
+        """Yields taxids present in this set, but not in the other one."""
+
+        for byte, value in enumerate(self.bits):
+            if byte < len(other.bits):
+                value &= ~other.bits[byte]
+
+            if value:
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield byte * 8 + bit
+
+def missing_parents(nodes_file):
+    """Checks a nodes dump file sorted by taxid and finds parents which
+    don't exist in it.
+
+    Only two bitmaps of seen and referenced taxids are kept in memory.
+
+    Params:
+        nodes_file (str): Path to a nodes dmp file.
+
+    Returns:
+        Generator yielding missing parent taxids as integers.
+
+    Raises:
+        DoubleRelies: if taxid occurs more than once in the file.
+        ValueError: if the file is not sorted by taxid.
+    """
+
+    seen = TaxidBitmap()
+    parents = TaxidBitmap()
+
+    previous = -1
+
+    for taxid, parent_taxid, _ in iter_nodes_dump(nodes_file):
+        current = int(taxid)
+
+        if current == previous:
+            raise DoubleRelies(taxid=taxid, parent_taxid=parent_taxid)
+        if current < previous:
+            raise ValueError('%s is not sorted by taxid.' % nodes_file)
+        previous = current
+
+        seen.add(current)
+        parents.add(int(parent_taxid))
+
+    return parents.difference(seen)
+
+def sorted_names(names_file):
+    """Iterates over scientific names in a dump file, checking whether it is
+    sorted by taxid.
+
+    Raises:
+        ValueError: if the file is not sorted by taxid.
+    """
+
+    previous = -1
+
+    for taxid, name in iter_names_dump(names_file):
+        if int(taxid) < previous:
+            raise ValueError('%s is not sorted by taxid.' % names_file)
+        previous = int(taxid)
+
+        yield taxid, name
+
+def join_nodes(names_file, nodes_file, batch_size=10000):
+    """Joins names and nodes dump files, both sorted by taxid, in a single
+    streaming pass.
+
+    Nodes file is checked in a cheap first pass, so no batch is yielded from
+    a dump with duplicated taxids, unsorted nodes or missing parents.
+    Afterwards only the current line of each file is kept in memory.
+
+    Params:
+        names_file (str): Path to a names dmp file.
+        nodes_file (str): Path to a nodes dmp file.
+        batch_size (int): Number of nodes in a batch.
+
+    Returns:
+        Generator yielding lists of Node objects, with ranks as node types.
+        Highest hierarchy nodes, pointing to themselves, are skipped.
+
+    Raises:
+        DoubleRelies: if taxid occurs more than once in the nodes file.
+        NoRecord: if there is no scientific name for a taxid.
+        MissingParent: if a parent node doesn't exist.
+        ValueError: if a file is not sorted by taxid.
+
+        All errors of the nodes file are raised before the first batch is
+        yielded. Errors of the names file may be raised later.
+    """
+
+    for parent_taxid in missing_parents(nodes_file):
+        raise MissingParent(parent_taxid=str(parent_taxid))
+
+    names = sorted_names(names_file)
+    name_taxid, name = next(names, (None, None))
+
+    batch = []
+
+    for taxid, parent_taxid, rank in iter_nodes_dump(nodes_file):
+        current = int(taxid)
+
+        # Skip names of taxids which come before the current node
+        while name_taxid is not None and int(name_taxid) < current:
+            name_taxid, name = next(names, (None, None))
+
+        if name_taxid != taxid:
+            # Name may be missing, or be further down an unsorted file,
+            # the rest of the file tells which one it is
+            for _ in names:
+                pass
+            raise NoRecord(taxid)
+
+        # Do not take highest hierarchy nodes
+        if taxid == parent_taxid:
+            continue
+
+        batch.append(Node(taxid=taxid,
+                          scientific_name=name,
+                          upper_hierarchy=parent_taxid,
+                          node_type=rank))
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
 def protein_taxid_links(file_path):
     """Reads protein - taxid links from NCBI link DB.
 
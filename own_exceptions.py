@@ -39,6 +39,17 @@ class DoubleRelies(Exception):
         return repr("Double rely in the database for pair %s:%s"
                     % (self.taxid, self.parent_taxid))
 
+
+class MissingParent(Exception):
+    """Exception raised when node points to a parent node which doesn't
+    exist."""
+
+    def __init__(self, parent_taxid):
+        self.parent_taxid = parent_taxid
+
+    def __str__(self):
+        return repr("Parent node %s doesn't exist." % self.parent_taxid)
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
\ No newline at end of file
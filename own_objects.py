@@ -1,5 +1,14 @@
 """Contains project-specific objects"""
 
+import re
+
+# Accessions made of a non-numeric prefix followed by a number,
+# e.g. 'WP_011112927', can be stored as integers
+ACCESSION_PATTERN = re.compile(r'^(\D*)(\d{1,12})$')
+
+# Integer key of an accession is prefix_code * PREFIX_FACTOR + number
+PREFIX_FACTOR = 10 ** 12
+
 class Node(object):
     """Describes Node object that is stored in the database as a document.
     Each node points to a parent node, unless tax_id = 0.
@@ -34,11 +43,78 @@ class Node(object):
         
         >>> nd['SciName']
         'Archaeoglobus fulgidus DSM 4304'
+
+        >>> 'Rank' in nd
+        False
             
         """
-        return {'TaxID': self.taxid,
-                'Parent': self.upper_hierarchy,
-                'SciName': self.scientific_name}
+        document = {'TaxID': self.taxid,
+                    'Parent': self.upper_hierarchy,
+                    'SciName': self.scientific_name}
+
+        # Rank is stored only if it is known
+        if self.node_type is not None:
+            document['Rank'] = self.node_type
+
+        return document
+
+    def compact_format(self):
+        """Formats object into compact post format, with integer taxids used
+        as document's _id and short field names.
+
+        Params:
+            None
+
+        Returns:
+            Dictionary representation of an object
+
+        e.g.:
+        >>> node = Node(taxid='224325',
+        ...             scientific_name='Archaeoglobus fulgidus DSM 4304',
+        ...             upper_hierarchy='2234')
+        >>> nd = node.compact_format()
+        >>> nd['_id'], nd['p']
+        (224325, 2234)
+
+        """
+        document = {'_id': int(self.taxid),
+                    'p': int(self.upper_hierarchy),
+                    'n': self.scientific_name}
+
+        if self.node_type is not None:
+            document['r'] = self.node_type
+
+        return document
+
+    @classmethod
+    def from_document(cls, document):
+        """Creates Node from a database document in either of the formats.
+
+        Params:
+            document (dict): Document retrieved from the nodes collection
+
+        Returns:
+            node (Node): Node object with string taxids
+
+        e.g.:
+        >>> node = Node.from_document({'_id': 2, 'p': 131567, 'n': 'Bacteria',
+        ...                            'r': 'superkingdom'})
+        >>> node.taxid, node.upper_hierarchy, node.scientific_name
+        ('2', '131567', 'Bacteria')
+        >>> node.node_type
+        'superkingdom'
+
+        """
+        if 'TaxID' in document:
+            return cls(taxid=document['TaxID'],
+                       scientific_name=document['SciName'],
+                       upper_hierarchy=document['Parent'],
+                       node_type=document.get('Rank'))
+
+        return cls(taxid=str(document['_id']),
+                   scientific_name=document['n'],
+                   upper_hierarchy=str(document['p']),
+                   node_type=document.get('r'))
     
 class ProteinLink(object):
     """Describes Protein link object that is stored in database's links
@@ -71,6 +147,179 @@ class ProteinLink(object):
         return {'ProteinID':self.protein_id,
                 'TaxID': self.taxid}
 
+    def compact_format(self, codec):
+        """Formats object into compact post format, with encoded accession
+        used as document's _id and integer taxid.
+
+        Params:
+            codec (AccessionCodec): Codec with accession's prefix registered
+
+        Returns:
+            Dictionary representation of an object.
+
+        e.g.:
+        >>> codec = AccessionCodec()
+        >>> _ = codec.add_prefix('WP_011112927')
+        >>> ProteinLink('WP_011112927', '915').compact_format(codec)
+        {'_id': 1000011112927, 't': 915}
+
+        """
+
+        return {'_id': codec.encode(self.protein_id),
+                't': int(self.taxid)}
+
+    @classmethod
+    def from_document(cls, document, codec=None):
+        """Creates ProteinLink from a database document in either of the
+        formats.
+
+        Params:
+            document (dict): Document retrieved from the links collection
+            codec (AccessionCodec): Codec required by the compact format
+
+        Returns:
+            protein_link (ProteinLink): ProteinLink object with string taxid
+        """
+
+        if 'ProteinID' in document:
+            return cls(protein_id=document['ProteinID'],
+                       taxid=document['TaxID'])
+
+        return cls(protein_id=codec.decode(document['_id']),
+                   taxid=str(document['t']))
+
+
+class AccessionCodec(object):
+    """Translates protein accessions into compact database keys.
+
+    Accession is split into a non-numeric prefix and a number, e.g.
+    'WP_011112927' into 'WP_' and 011112927. Prefix, together with the number
+    of digits, is kept in a prefix dictionary and the key is a single integer
+    made of prefix code and the number. Accessions which cannot be split
+    this way (e.g. 'Q8I6R7') are kept as they are.
+
+    e.g.:
+    >>> codec = AccessionCodec()
+    >>> codec.add_prefix('WP_011112927')
+    {'_id': 1, 'p': 'WP_', 'd': 9}
+    >>> codec.encode('WP_000000001')
+    1000000000001
+    >>> codec.decode(1000000000001)
+    'WP_000000001'
+    >>> codec.encode('Q8I6R7')
+    'Q8I6R7'
+    >>> codec.encode('XP_1') is None
+    True
+    >>> codec.new_prefix('XP_000001')
+    {'_id': 2, 'p': 'XP_', 'd': 6}
+    >>> codec.encode('XP_000001') is None
+    True
+
+    """
+
+    def __init__(self, prefixes=None):
+        """Creates codec from prefix documents stored in the database."""
+
+        self.codes = {}
+        self.prefixes = {}
+
+        for prefix in prefixes or []:
+            self.load(prefix)
+
+    def load(self, prefix):
+        """Adds prefix document to the codec."""
+
+        self.codes[(prefix['p'], prefix['d'])] = prefix['_id']
+        self.prefixes[prefix['_id']] = (prefix['p'], prefix['d'])
+
+    @staticmethod
+    def split(protein_acc):
+        """Splits accession into (prefix, digits) and number or returns
+        None if it is not possible."""
+
+        match = ACCESSION_PATTERN.match(protein_acc)
+
+        if not match:
+            return None
+
+        prefix, number = match.groups()
+        return (prefix, len(number)), int(number)
+
+    def new_prefix(self, protein_acc):
+        """Describes prefix of an accession with the next free code, without
+        registering it.
+
+        Params:
+            protein_acc (str): Protein accession
+
+        Returns:
+            prefix (dict): Document describing a new prefix, None if prefix
+                           is already known or accession has no prefix.
+        """
+
+        parts = self.split(protein_acc)
+
+        if not parts or parts[0] in self.codes:
+            return None
+
+        prefix = parts[0]
+        code = max(self.prefixes or [0]) + 1
+
+        return {'_id': code, 'p': prefix[0], 'd': prefix[1]}
+
+    def add_prefix(self, protein_acc):
+        """Registers prefix of an accession.
+
+        Params:
+            protein_acc (str): Protein accession
+
+        Returns:
+            prefix (dict): Document describing a new prefix, None if prefix
+                           was already known or accession has no prefix.
+        """
+
+        prefix = self.new_prefix(protein_acc)
+
+        if prefix:
+            self.load(prefix)
+
+        return prefix
+
+    def encode(self, protein_acc):
+        """Translates accession into database key.
+
+        Params:
+            protein_acc (str): Protein accession
+
+        Returns:
+            key (int or str): Database key, None if accession prefix is
+                              unknown, so accession cannot be in the database.
+        """
+
+        parts = self.split(protein_acc)
+
+        if not parts:
+            return protein_acc
+
+        prefix, number = parts
+        code = self.codes.get(prefix)
+
+        if code is None:
+            return None
+
+        return code * PREFIX_FACTOR + number
+
+    def decode(self, key):
+        """Translates database key back into accession."""
+
+        if not isinstance(key, int):
+            return key
+
+        code, number = divmod(key, PREFIX_FACTOR)
+        prefix, digits = self.prefixes[code]
+
+        return '%s%0*d' % (prefix, digits, number)
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
\ No newline at end of file
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+
+"""Taxonomy tree shared between processes through a memory mapped file.
+
+Parent array, name offsets and names of all nodes are packed into a single
+file, which every process maps read-only. Lookups read the mapping directly,
+so the operating system keeps a single copy of the data in memory, no matter
+how many workers use it. Placing the file on a RAM backed file system
+(e.g. /dev/shm) keeps it in shared memory entirely.
+
+File layout (native byte order of arrays):
+    header        magic, layout version, number of rank tables, data version,
+                  slots, names size, rank names size
+    parents       int32[slots], parent taxid of each taxid, -1 if missing
+    name offsets  uint32[slots + 1], offsets of names in the names blob
+    rank tables   int32[slots] for each of RANK_TABLES, ancestor of each
+                  taxid at the rank, -1 if there is none
+    ranks         uint8[slots], index of each taxid's rank in rank names
+    rank names    names of all ranks, separated with newlines, starting
+                  with RANK_TABLES
+    names         UTF-8 encoded names, concatenated in taxid order
+
+File is replaced atomically when data is refreshed. Processes which still
+map the old file keep reading it until they call refresh().
+
+To publish taxonomy from the database (as set in db.cfg) type:
+python sharedtaxonomy.py [OUT_FILE]
+
+or, to publish it directly from NCBI dump files:
+python sharedtaxonomy.py [OUT_FILE] [PATH_TO_NCBI_DIR]
+"""
+
+# External libraries imports
+from os import sys
+import array
+import mmap
+import os
+import struct
+import time
+
+from own_objects import Node
+
+MAGIC = b'BTAXTREE'
+LAYOUT_VERSION = 2
+
+# magic, layout version, number of rank tables, data version, slots,
+# names size, rank names size
+HEADER = struct.Struct('<8sIIQQQQ')
+
+# Maximal number of levels walked up the tree
+MAX_DEPTH = 256
+
+# Ranks with precomputed ancestor tables
+RANK_TABLES = ('domain', 'superkingdom', 'kingdom', 'phylum', 'class',
+               'order', 'family', 'genus', 'species')
+
+# Rank code of nodes without rank
+NO_RANK = 255
+
+
+def compute_rank_tables(parents, ranks, table_count):
+    """Computes ancestors of each taxid at ranks with tables.
+
+    Nodes are processed from the top of the tree, so every node copies
+    tables of its parent, which are already complete.
+
+    Params:
+        parents (array): Parent taxid of each taxid, -1 if missing
+        ranks (bytearray): Rank code of each taxid
+        table_count (int): Number of rank codes with tables
+
+    Returns:
+        tables (list): Arrays of ancestor taxids, one per rank code
+
+    e.g.:
+    >>> parents = array.array('i', [-1, 1, 1, 2, 3])
+    >>> tables = compute_rank_tables(parents, bytearray([255, 255, 0, 255, 1]),
+    ...                              2)
+    >>> list(tables[0]), list(tables[1])
+    ([-1, -1, 2, 2, 2], [-1, -1, -1, -1, 4])
+    """
+
+    slots = len(parents)
+    tables = [array.array('i', [-1]) * slots for _ in range(table_count)]
+
+    # 0 - not visited, 1 - on the current path, 2 - done
+    state = bytearray(slots)
+
+    for taxid in range(slots):
+        if parents[taxid] < 0 or state[taxid]:
+            continue
+
+        # Walk up until a done node, the root, a missing node or a cycle
+        path = []
+        current = taxid
+        while 0 <= current < slots and parents[current] >= 0 \
+                and not state[current]:
+            state[current] = 1
+            path.append(current)
+
+            if parents[current] == current:
+                break
+            current = parents[current]
+
+        for node in reversed(path):
+            parent = parents[node]
+            inherit = (parent != node and 0 <= parent < slots and
+                       state[parent] == 2)
+
+            for code, table in enumerate(tables):
+                if ranks[node] == code:
+                    table[node] = node
+                elif inherit:
+                    table[node] = table[parent]
+
+            state[node] = 2
+
+    return tables
+
+
+def pack_taxonomy(nodes, version=None):
+    """Packs taxonomy into the shared layout.
+
+    Params:
+        nodes (iterable): Node objects
+        version (int): Data version, current time if not given
+
+    Returns:
+        data (bytes): Packed taxonomy
+    """
+
+    if version is None:
+        version = int(time.time())
+
+    parents = array.array('i')
+    names = []
+    ranks = bytearray()
+
+    rank_names = list(RANK_TABLES)
+    rank_codes = dict((rank, code) for code, rank in enumerate(rank_names))
+
+    for node in nodes:
+        taxid = int(node.taxid)
+
+        if taxid >= len(parents):
+            missing = taxid + 1 - len(parents)
+            parents.extend([-1] * missing)
+            names.extend([None] * missing)
+            ranks.extend([NO_RANK] * missing)
+
+        parents[taxid] = int(node.upper_hierarchy)
+        names[taxid] = node.scientific_name.encode('utf-8')
+
+        if node.node_type is not None:
+            if node.node_type not in rank_codes:
+                rank_codes[node.node_type] = len(rank_names)
+                rank_names.append(node.node_type)
+
+            ranks[taxid] = rank_codes[node.node_type]
+
+    offsets = array.array('I', [0])
+    for name in names:
+        offsets.append(offsets[-1] + len(name or b''))
+
+    blob = b''.join(name for name in names if name)
+    tables = compute_rank_tables(parents, ranks, len(RANK_TABLES))
+    rank_blob = '\n'.join(rank_names).encode('utf-8')
+
+    header = HEADER.pack(MAGIC, LAYOUT_VERSION, len(RANK_TABLES), version,
+                         len(parents), len(blob), len(rank_blob))
+
+    return b''.join([header, parents.tobytes(), offsets.tobytes()] +
+                    [table.tobytes() for table in tables] +
+                    [bytes(ranks), rank_blob, blob])
+
+
+def published_version(file_path):
+    """Returns data version of a published file, None if there is none."""
+
+    try:
+        with open(file_path, 'rb') as handle:
+            header = handle.read(HEADER.size)
+    except (IOError, OSError):
+        return None
+
+    if len(header) < HEADER.size:
+        return None
+
+    magic, layout, _, version, _, _, _ = HEADER.unpack(header)
+
+    if magic != MAGIC or layout != LAYOUT_VERSION:
+        return None
+
+    return version
+
+
+def publish(nodes, file_path, version=None):
+    """Writes packed taxonomy to a file, replacing the old one atomically.
+
+    Params:
+        nodes (iterable): Node objects
+        file_path (str): Path to the shared taxonomy file
+        version (int): Data version. If not given, current time, but always
+                       greater than version of the file being replaced, so
+                       readers see a new version even within one second.
+
+    Returns:
+        version (int): Version of the published data
+    """
+
+    if version is None:
+        version = int(time.time())
+        previous = published_version(file_path)
+
+        if previous is not None and version <= previous:
+            version = previous + 1
+
+    data = pack_taxonomy(nodes, version)
+    tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+
+    with open(tmp_path, 'wb') as handle:
+        handle.write(data)
+
+    os.replace(tmp_path, file_path)
+
+    return HEADER.unpack_from(data)[3]
+
+
+class SharedTaxonomy(object):
+    """Read-only view of a published taxonomy file.
+
+    e.g.:
+    >>> import tempfile
+    >>> from own_objects import Node
+    >>> file_path = os.path.join(tempfile.mkdtemp(), 'taxonomy.bin')
+    >>> publish([Node('2', 'Bacteria', '131567', 'superkingdom'),
+    ...          Node('6', 'Azorhizobium', '2', 'genus'),
+    ...          Node('131567', 'cellular organisms', '1')], file_path, 1)
+    1
+    >>> taxonomy = SharedTaxonomy(file_path)
+    >>> taxonomy.lineage('2')
+    ['cellular organisms', 'Bacteria']
+    >>> taxonomy.lineage('3') is None
+    True
+    >>> taxonomy.rank_lineage('6', ['superkingdom', 'phylum', 'genus'])
+    ['Bacteria', None, 'Azorhizobium']
+
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._map = None
+        self.refresh()
+
+    def identity(self):
+        """Returns identity of the file currently published at file_path."""
+
+        stat = os.stat(self.file_path)
+        return (stat.st_dev, stat.st_ino, stat.st_mtime)
+
+    def stale(self):
+        """Checks whether the file was replaced since it was mapped."""
+
+        return self.identity() != self._identity
+
+    def refresh(self):
+        """Maps the file again if it was replaced since it was mapped.
+
+        Lookups running in other threads during a refresh may read a mix of
+        both versions. Threaded readers should rather create a new object
+        when the mapping is stale().
+
+        Returns:
+            refreshed (bool): Whether a new version was mapped
+        """
+
+        identity = self.identity()
+
+        if self._map is not None and identity == self._identity:
+            return False
+
+        with open(self.file_path, 'rb') as handle:
+            new_map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, layout, table_count, version, slots, names_size, \
+            rank_names_size = HEADER.unpack_from(new_map)
+
+        if magic != MAGIC or layout != LAYOUT_VERSION:
+            new_map.close()
+            raise ValueError('%s is not a shared taxonomy file of layout %d.'
+                             % (self.file_path, LAYOUT_VERSION))
+
+        view = memoryview(new_map)
+        start = HEADER.size
+        parents = view[start:start + 4 * slots].cast('i')
+        start += 4 * slots
+        offsets = view[start:start + 4 * (slots + 1)].cast('I')
+        start += 4 * (slots + 1)
+
+        tables = {}
+        for rank in RANK_TABLES[:table_count]:
+            tables[rank] = view[start:start + 4 * slots].cast('i')
+            start += 4 * slots
+
+        ranks = view[start:start + slots]
+        start += slots
+        rank_names = view[start:start + rank_names_size].tobytes()
+        start += rank_names_size
+        names = view[start:start + names_size]
+
+        # Old mapping is closed by the garbage collector, when views
+        # still in use elsewhere are released
+        self._map = new_map
+        self._identity = identity
+        self.version = version
+        self.slots = slots
+        self.parents = parents
+        self.offsets = offsets
+        self.names = names
+        self.tables = tables
+        self.ranks = ranks
+        self.rank_names = rank_names.decode('utf-8').split('\n')
+        self.rank_codes = dict((rank, code)
+                               for code, rank in enumerate(self.rank_names))
+
+        return True
+
+    def parent(self, taxid):
+        """Returns parent taxid as int, -1 if taxid doesn't exist."""
+
+        if 0 <= taxid < self.slots:
+            return self.parents[taxid]
+
+        return -1
+
+    def name(self, taxid):
+        """Returns scientific name of an existing taxid."""
+
+        return self.names[self.offsets[taxid]:
+                          self.offsets[taxid + 1]].tobytes().decode('utf-8')
+
+    def rank(self, taxid):
+        """Returns rank of an existing taxid, None if it has no rank."""
+
+        code = self.ranks[taxid]
+
+        if code == NO_RANK:
+            return None
+
+        return self.rank_names[code]
+
+    def node(self, taxid):
+        """Returns Node of a taxid, None if it doesn't exist."""
+
+        try:
+            current = int(taxid)
+        except ValueError:
+            return None
+
+        parent = self.parent(current)
+        if parent < 0:
+            return None
+
+        return Node(str(current), self.name(current), str(parent),
+                    self.rank(current))
+
+    def ancestor_at_rank(self, taxid, rank, max_depth=MAX_DEPTH):
+        """Returns ancestor of a taxid at a given rank.
+
+        Ranks from RANK_TABLES are read from precomputed tables with
+        a single lookup, others require walking up the tree.
+
+        Params:
+            taxid (int): Taxonomy ID
+            rank (str): Rank, e.g. 'genus'
+            max_depth (int): Maximal number of levels walked up the tree
+
+        Returns:
+            ancestor (int): Taxid of the ancestor, the taxid itself if it is
+                            of the rank, -1 if there is no such ancestor.
+        """
+
+        if self.parent(taxid) < 0:
+            return -1
+
+        table = self.tables.get(rank)
+        if table is not None:
+            return table[taxid]
+
+        code = self.rank_codes.get(rank)
+        if code is None:
+            return -1
+
+        # Visited taxids stop the walk at a parent cycle
+        visited = set()
+
+        for _ in range(max_depth):
+            if self.ranks[taxid] == code:
+                return taxid
+
+            visited.add(taxid)
+            parent = self.parent(taxid)
+            if parent < 0 or parent in visited:
+                break
+            taxid = parent
+
+        return -1
+
+    def rank_lineage(self, taxid, ranks):
+        """Returns names of ancestors of a taxid at given ranks.
+
+        Params:
+            taxid (str): Taxonomy ID
+            ranks (list): Ranks, e.g. ['superkingdom', 'phylum', 'genus']
+
+        Returns:
+            names (list): Name of the ancestor at each rank, None where
+                          there is none. None if taxid doesn't exist.
+        """
+
+        try:
+            current = int(taxid)
+        except ValueError:
+            return None
+
+        if self.parent(current) < 0:
+            return None
+
+        names = []
+        for rank in ranks:
+            ancestor = self.ancestor_at_rank(current, rank)
+            names.append(self.name(ancestor) if ancestor >= 0 else None)
+
+        return names
+
+    def lineage(self, taxid, max_depth=MAX_DEPTH):
+        """Returns lineage of a taxid.
+
+        Params:
+            taxid (str): Taxonomy ID
+            max_depth (int): Maximal number of levels walked up the tree
+
+        Returns:
+            lineage (list): Lineage from the highest hierarchy node down to
+                            the taxid, None if taxid doesn't exist. Walk
+                            stops at a node pointing to itself, at a missing
+                            parent or when a parent cycle is detected.
+        """
+
+        try:
+            current = int(taxid)
+        except ValueError:
+            return None
+
+        parent = self.parent(current)
+        if parent < 0:
+            return None
+
+        lineage = []
+        visited = set()
+
+        while (parent >= 0 and current not in visited and
+               len(lineage) < max_depth):
+            visited.add(current)
+            lineage.append(self.name(current))
+
+            current = parent
+            parent = self.parent(current)
+
+        lineage.reverse()
+        return lineage
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        import ncbi_taxonomies as ncbi
+
+        batches = ncbi.join_nodes('%s/names.dmp' % sys.argv[2],
+                                  '%s/nodes.dmp' % sys.argv[2])
+        version = publish((node for batch in batches for node in batch),
+                          sys.argv[1])
+    else:
+        from taxonomydb import TaxDb
+
+        database = TaxDb()
+        version = publish(database.iter_nodes(), sys.argv[1])
+        database.disconnect()
+
+    print('Published taxonomy version %d to %s' % (version, sys.argv[1]))
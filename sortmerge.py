@@ -0,0 +1,167 @@
+"""External sorting and merge joining of records that do not fit in memory.
+
+Records are tuples of strings without tabs and newlines. When there are more
+of them than fit in a buffer, sorted runs are spilled to temporary files and
+merged back sequentially. If there are more runs than MAX_FAN_IN, they are
+first merged in passes into fewer, longer runs.
+"""
+
+import heapq
+import os
+import tempfile
+
+# Maximal number of runs merged at once. Each of them holds an open file and
+# several sorts may be merging at the same time, e.g. in merge_join.
+MAX_FAN_IN = 128
+
+
+def spill_run(records, tmp_dir=None):
+    """Writes sorted records to a temporary file.
+
+    Params:
+        records (list): Sorted records
+        tmp_dir (str): Directory for temporary files
+
+    Returns:
+        file_path (str): Path to the temporary file
+    """
+
+    handle, file_path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+
+    with os.fdopen(handle, 'w') as run:
+        for record in records:
+            run.write('\t'.join(record))
+            run.write('\n')
+
+    return file_path
+
+
+def read_run(handle):
+    """Reads records back from a temporary file."""
+
+    for line in handle:
+        yield tuple(line.rstrip('\n').split('\t'))
+
+
+def merge_runs(runs, key=None, tmp_dir=None):
+    """Merges sorted temporary files into a new one.
+
+    Params:
+        runs (list): Paths to temporary files with sorted records
+        key (function): Sort key, as in sorted()
+        tmp_dir (str): Directory for temporary files
+
+    Returns:
+        file_path (str): Path to the merged temporary file
+    """
+
+    handles = [open(run, 'r') for run in runs]
+    try:
+        return spill_run(heapq.merge(*[read_run(handle)
+                                       for handle in handles], key=key),
+                         tmp_dir)
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def external_sort(records, key=None, buffer_size=1000000, tmp_dir=None,
+                  fan_in=MAX_FAN_IN):
+    """Sorts records with bounded memory.
+
+    Params:
+        records (iterable): Records to sort
+        key (function): Sort key, as in sorted()
+        buffer_size (int): Number of records sorted in memory at once
+        tmp_dir (str): Directory for temporary files
+        fan_in (int): Maximal number of temporary files open at once
+
+    Returns:
+        Generator yielding sorted records. Temporary files are removed when
+        the generator is exhausted or closed.
+
+    e.g.:
+    >>> records = [('b', '2'), ('c', '1'), ('a', '3')]
+    >>> list(external_sort(records, buffer_size=2))
+    [('a', '3'), ('b', '2'), ('c', '1')]
+    >>> list(external_sort(records, key=lambda r: int(r[1]), buffer_size=2))
+    [('c', '1'), ('b', '2'), ('a', '3')]
+    """
+
+    runs = []
+    buffer = []
+
+    try:
+        for record in records:
+            buffer.append(record)
+
+            if len(buffer) == buffer_size:
+                buffer.sort(key=key)
+                runs.append(spill_run(buffer, tmp_dir))
+                buffer = []
+
+        buffer.sort(key=key)
+
+        # Everything fit in memory, no need to merge
+        if not runs:
+            for record in buffer:
+                yield record
+            return
+
+        runs.append(spill_run(buffer, tmp_dir))
+        buffer = []
+
+        # Merge oldest runs first, so runs of similar length are merged
+        while len(runs) > fan_in:
+            runs.append(merge_runs(runs[:fan_in], key, tmp_dir))
+
+            merged = runs[:fan_in]
+            del runs[:fan_in]
+            for run in merged:
+                os.remove(run)
+
+        handles = [open(run, 'r') for run in runs]
+        try:
+            for record in heapq.merge(*[read_run(handle)
+                                        for handle in handles], key=key):
+                yield record
+        finally:
+            for handle in handles:
+                handle.close()
+
+    finally:
+        for run in runs:
+            os.remove(run)
+
+
+def merge_join(queries, links):
+    """Joins two streams of records sorted by their first field.
+
+    Params:
+        queries (iterable): (key, value) records, keys may repeat
+        links (iterable): (key, link) records with unique keys
+
+    Returns:
+        Generator yielding (value, link) pairs for keys present in both
+        streams, in the order of queries.
+
+    e.g.:
+    >>> queries = [('P1', '0'), ('P1', '3'), ('P2', '1'), ('P4', '2')]
+    >>> links = [('P0', '7'), ('P1', '9'), ('P3', '2'), ('P4', '5')]
+    >>> list(merge_join(queries, links))
+    [('0', '9'), ('3', '9'), ('2', '5')]
+    """
+
+    links = iter(links)
+    link = next(links, None)
+
+    for key, value in queries:
+        # Skip links which come before the current key
+        while link is not None and link[0] < key:
+            link = next(links, None)
+
+        if link is None:
+            return
+
+        if link[0] == key:
+            yield value, link[1]
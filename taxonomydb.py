@@ -4,10 +4,118 @@ import doctest
 import pymongo
 import os
 import json
-from pymongo.errors import AutoReconnect
+import threading
+import time
+from pymongo.errors import AutoReconnect, BulkWriteError
 
 from own_exceptions import NoProteinLink, NoRecord
-from own_objects import Node
+from own_objects import Node, ProteinLink, AccessionCodec
+from sharedtaxonomy import SharedTaxonomy, MAX_DEPTH
+
+
+def walk_nodes(taxid, find_node, max_depth=MAX_DEPTH):
+    """Walks up the taxonomy tree iteratively.
+
+    Params:
+        taxid (str): Taxonomy ID
+        find_node (function): Returns Node of a taxid, None if it doesn't
+                              exist
+        max_depth (int): Maximal number of levels walked up the tree
+
+    Returns:
+        nodes (list): Nodes from the highest hierarchy node down to the
+                      taxid, None if taxid doesn't exist. Walk stops at
+                      a node pointing to itself, at a missing parent or
+                      when a parent cycle is detected.
+    """
+
+    node = find_node(taxid)
+
+    if node is None:
+        return None
+
+    nodes = []
+    visited = set()
+
+    while (node is not None and node.taxid not in visited and
+           len(nodes) < max_depth):
+        visited.add(node.taxid)
+        nodes.append(node)
+
+        # Highest hierarchy possible
+        if node.upper_hierarchy == node.taxid:
+            break
+
+        node = find_node(node.upper_hierarchy)
+
+    nodes.reverse()
+    return nodes
+
+
+def walk_lineage(taxid, find_node, max_depth=MAX_DEPTH):
+    """Walks up the taxonomy tree iteratively and collects names.
+
+    Params:
+        taxid (str): Taxonomy ID
+        find_node (function): Returns Node of a taxid, None if it doesn't
+                              exist
+        max_depth (int): Maximal number of levels walked up the tree
+
+    Returns:
+        lineage (list): Lineage from the highest hierarchy node down to the
+                        taxid, None if taxid doesn't exist.
+
+    e.g.:
+    >>> nodes = {'2': Node('2', 'Bacteria', '131567'),
+    ...          '131567': Node('131567', 'cellular organisms', '1'),
+    ...          '5': Node('5', 'A', '6'), '6': Node('6', 'B', '5')}
+    >>> walk_lineage('2', nodes.get)
+    ['cellular organisms', 'Bacteria']
+    >>> walk_lineage('5', nodes.get)
+    ['B', 'A']
+    >>> walk_lineage('3', nodes.get) is None
+    True
+    """
+
+    nodes = walk_nodes(taxid, find_node, max_depth)
+
+    if nodes is None:
+        return None
+
+    return [node.scientific_name for node in nodes]
+
+
+def walk_ranks(taxid, find_node, ranks, max_depth=MAX_DEPTH):
+    """Walks up the taxonomy tree iteratively and collects names of nodes
+    at given ranks.
+
+    Params:
+        taxid (str): Taxonomy ID
+        find_node (function): Returns Node of a taxid, None if it doesn't
+                              exist
+        ranks (list): Ranks, e.g. ['superkingdom', 'phylum', 'genus']
+        max_depth (int): Maximal number of levels walked up the tree
+
+    Returns:
+        names (list): Name of the ancestor at each rank, None where there is
+                      none. None if taxid doesn't exist.
+
+    e.g.:
+    >>> nodes = {'2': Node('2', 'Bacteria', '131567', 'superkingdom'),
+    ...          '6': Node('6', 'Azorhizobium', '2', 'genus')}
+    >>> walk_ranks('6', nodes.get, ['superkingdom', 'phylum', 'genus'])
+    ['Bacteria', None, 'Azorhizobium']
+    """
+
+    nodes = walk_nodes(taxid, find_node, max_depth)
+
+    if nodes is None:
+        return None
+
+    # Lowest node of a rank wins, in case a rank repeats
+    names = dict((node.node_type, node.scientific_name) for node in nodes)
+
+    return [names.get(rank) for rank in ranks]
 
 
 # MongoDB connection test for methods requiring database access
@@ -45,15 +153,62 @@ class TaxDb(object):
         cfg = self.read_db_cfg(cfg_file)
 
         # Parse database configuration
-        self.HOSTNAME = cfg['HOSTNAME']
-        self.PORT = int(cfg['PORT'])
+        self.HOSTNAME = cfg.get('HOSTNAME', 'localhost')
+        self.PORT = int(cfg.get('PORT', 27017))
         self.NAME = cfg['NAME']
 
-        self.db_client = pymongo.MongoClient(self.HOSTNAME, self.PORT)
+        # Storage schema, either 'legacy' or 'compact'
+        self.SCHEMA = cfg.get('SCHEMA', 'legacy')
+        self.compact = self.SCHEMA == 'compact'
+
+        # Replica set / sharded cluster configuration. URI may list several
+        # hosts, e.g. mongodb://host1,host2,host3/?replicaSet=rs0, and reads
+        # are spread across replicas with read preference other than primary
+        self.URI = cfg.get('URI')
+        self.READ_PREFERENCE = cfg.get('READ_PREFERENCE', 'primary')
+        self.SHARD_LINKS = cfg.get('SHARD_LINKS', False)
+
+        options = {'readPreference': self.READ_PREFERENCE}
+        if 'LOCAL_THRESHOLD_MS' in cfg:
+            options['localThresholdMS'] = int(cfg['LOCAL_THRESHOLD_MS'])
+
+        if self.URI:
+            self.db_client = pymongo.MongoClient(self.URI, **options)
+        else:
+            self.db_client = pymongo.MongoClient(self.HOSTNAME, self.PORT,
+                                                 **options)
 
         database = self.db_client[self.NAME]
         self.db_nodes = database.nodes
         self.db_links = database.links
+        # Prefix codes are allocated on the primary, so the dictionary is
+        # always read from there, never from a lagging secondary
+        self.db_prefixes = database.prefixes.with_options(
+            read_preference=pymongo.ReadPreference.PRIMARY)
+
+        # Compact schema stores accessions split into prefix and number
+        if self.compact:
+            self.reload_prefixes()
+        else:
+            self.codec = None
+
+        self._prefix_index = False
+
+        # Lineages can be read from a taxonomy file shared between processes
+        # instead of the nodes collection
+        self.SHARED_TAXONOMY = cfg.get('SHARED_TAXONOMY')
+
+        # Seconds between checks whether a new taxonomy file was published
+        self.SHARED_TAXONOMY_REFRESH = float(cfg.get('SHARED_TAXONOMY_REFRESH',
+                                                     10))
+
+        if self.SHARED_TAXONOMY:
+            self.shared_taxonomy = SharedTaxonomy(self.SHARED_TAXONOMY)
+        else:
+            self.shared_taxonomy = None
+
+        self._next_refresh = time.time() + self.SHARED_TAXONOMY_REFRESH
+        self._refresh_lock = threading.Lock()
 
     @staticmethod
     def read_db_cfg(cfg_file=None):
@@ -70,6 +225,27 @@ class TaxDb(object):
 
         self.db_client.close()
 
+    @autoreconnect_retry
+    def shard_links(self):
+        """Shards links collection with a hashed key on protein accession.
+        Requires connection to a mongos router of a sharded cluster.
+
+        Params:
+            None
+
+        Returns:
+            result (dict): Response to the shardCollection command
+        """
+
+        # Compact schema keeps accessions in _id
+        key = '_id' if self.compact else 'ProteinID'
+
+        admin = self.db_client.admin
+        admin.command('enableSharding', self.NAME)
+
+        return admin.command('shardCollection', '%s.links' % self.NAME,
+                             key={key: 'hashed'})
+
     @autoreconnect_retry
     def add_record(self, node):
         """Method updates database with a new entry.
@@ -83,10 +259,25 @@ class TaxDb(object):
         """
 
         try:
-            self.db_nodes.insert_one(node.post_format())
+            self.db_nodes.insert_one(self.node_document(node))
         except pymongo.errors.DuplicateKeyError:
             print('%s already exists. Record not inserted.' % node.taxid)
 
+    @autoreconnect_retry
+    def add_records(self, nodes):
+        """Method updates database with a batch of new entries. Records which
+        already exist are not inserted.
+
+        Params:
+            nodes (list): TaxDB node objects
+
+        Returns:
+            inserted (int): Number of newly added records.
+        """
+
+        return self._insert_many(self.db_nodes,
+                                 [self.node_document(node) for node in nodes])
+
     @autoreconnect_retry
     def add_protein_link(self, protein_link):
         """Method updates database with a new protein link.
@@ -98,12 +289,162 @@ class TaxDb(object):
         """
 
         try:
-            self.db_links.insert_one(protein_link.post_format())
+            self.db_links.insert_one(self.link_document(protein_link))
         except pymongo.errors.DuplicateKeyError:
             print('%s already exists, link not inserted.'
                   % protein_link.protein_id)
 
     @autoreconnect_retry
+    def add_protein_links(self, protein_links):
+        """Method updates database with a batch of new protein links. Links
+        which already exist are not inserted.
+
+        Params:
+            protein_links (list): ProteinLink objects
+
+        Returns:
+            inserted (int): Number of newly added links
+        """
+
+        return self._insert_many(self.db_links,
+                                 [self.link_document(link)
+                                  for link in protein_links])
+
+    @staticmethod
+    def _insert_many(collection, documents):
+        """Inserts documents skipping duplicates, returns number of inserted
+        documents."""
+
+        if not documents:
+            return 0
+
+        try:
+            return len(collection.insert_many(documents,
+                                              ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            return e.details['nInserted']
+
+    def node_document(self, node):
+        """Formats node according to the database schema."""
+
+        if self.compact:
+            return node.compact_format()
+
+        return node.post_format()
+
+    def link_document(self, protein_link):
+        """Formats protein link according to the database schema. Registers
+        accession prefix if it is not known yet."""
+
+        if not self.compact:
+            return protein_link.post_format()
+
+        self.register_prefix(protein_link.protein_id)
+
+        return protein_link.compact_format(self.codec)
+
+    def reload_prefixes(self):
+        """Reads accession prefix dictionary again, so prefixes registered
+        by other processes are known."""
+
+        self.codec = AccessionCodec(self.db_prefixes.find())
+
+    def register_prefix(self, protein_id):
+        """Assigns a code to accession prefix if it is not known yet.
+
+        Unique indexes on code and prefix make sure concurrent loaders never
+        give one code to two prefixes, nor two codes to one prefix. Loader
+        which loses a race reads the dictionary again and retries. Prefix is
+        added to the codec only once it is stored, so a failed insert never
+        leaves a code used only by this process.
+
+        Params:
+            protein_id (str): Protein accession
+        """
+
+        new_prefix = self.codec.new_prefix(protein_id)
+
+        if new_prefix and not self._prefix_index:
+            self.db_prefixes.create_index([('p', pymongo.ASCENDING),
+                                           ('d', pymongo.ASCENDING)],
+                                          unique=True)
+            self._prefix_index = True
+
+        while new_prefix:
+            try:
+                self.db_prefixes.insert_one(new_prefix)
+            except pymongo.errors.DuplicateKeyError:
+                self.reload_prefixes()
+                new_prefix = self.codec.new_prefix(protein_id)
+            else:
+                self.codec.load(new_prefix)
+                return
+
+    def node_query(self, taxid):
+        """Creates query finding node by its taxid."""
+
+        if not self.compact:
+            return {'TaxID': taxid}
+
+        try:
+            return {'_id': int(taxid)}
+        except ValueError:
+            return None
+
+    def link_key(self, protein_id):
+        """Returns value of links collection's key field for an accession."""
+
+        if not self.compact:
+            return protein_id
+
+        key = self.codec.encode(protein_id)
+
+        # Prefix may have been registered since the dictionary was read
+        if key is None:
+            self.reload_prefixes()
+            key = self.codec.encode(protein_id)
+
+        return key
+
+    def iter_nodes(self):
+        """Iterates over all nodes stored in the database.
+
+        Returns:
+            Generator yielding Node objects.
+        """
+
+        for document in self.db_nodes.find():
+            yield Node.from_document(document)
+
+    def iter_protein_links(self):
+        """Iterates over all protein links stored in the database.
+
+        Returns:
+            Generator yielding ProteinLink objects.
+        """
+
+        for document in self.db_links.find():
+            yield ProteinLink.from_document(document, self.codec)
+
+    @autoreconnect_retry
+    def find_node(self, taxid):
+        """Returns node record from database.
+
+        Params:
+            taxid (str): Taxonomy ID
+
+        Returns:
+            record (Node): Node record, None if it doesn't exist
+        """
+
+        query = self.node_query(taxid)
+        result = self.db_nodes.find_one(query) if query else None
+
+        if not result:
+            return None
+
+        return Node.from_document(result)
+
     def get_node(self, taxid):
         """Returns node record from database.
 
@@ -112,19 +453,41 @@ class TaxDb(object):
 
         Returns:
             record (Node): Node record
+
+        Raises:
+            NoRecord: if node doesn't exist
         """
 
-        result = self.db_nodes.find_one({'TaxID': taxid})
+        record = self.find_node(taxid)
 
-        if not result:
+        if record is None:
             raise NoRecord(taxid)
 
-        record = Node(taxid=result['TaxID'],
-                      scientific_name=result['SciName'],
-                      upper_hierarchy=result['Parent'])
-
         return record
 
+    @autoreconnect_retry
+    def get_nodes(self, taxids):
+        """Returns a batch of node records from database in a single query.
+
+        Params:
+            taxids (list): Taxonomy IDs
+
+        Returns:
+            records (dict): {taxid: Node} pairs for taxids that exist in the
+                            database. Missing ones are left out.
+        """
+
+        if self.compact:
+            query = {'_id': {'$in': [int(taxid) for taxid in taxids
+                                     if taxid.isdigit()]}}
+        else:
+            query = {'TaxID': {'$in': list(taxids)}}
+
+        records = (Node.from_document(document)
+                   for document in self.db_nodes.find(query))
+
+        return dict((record.taxid, record) for record in records)
+
     @autoreconnect_retry
     def search_scientific_name(self, sci_name):
         """Search Database with scientific name
@@ -137,27 +500,266 @@ class TaxDb(object):
 
         """
 
-        result = self.db_nodes.find_one({'SciName': sci_name})
+        name_field = 'n' if self.compact else 'SciName'
+        result = self.db_nodes.find_one({name_field: sci_name})
 
         if not result:
             raise NoRecord(sci_name)
 
-        record = Node(taxid=result['TaxID'],
-                      scientific_name=result['SciName'],
-                      upper_hierarchy=result['Parent'])
-
-        return record
+        return Node.from_document(result)
 
     @autoreconnect_retry
+    def find_protein_taxid(self, protein_id):
+        """Translates protein id to taxonomy id.
+
+        Params:
+            protein_id (str): Protein accession
+
+        Returns:
+            taxid (str): Taxonomy ID, None if there is no link
+        """
+
+        key = self.link_key(protein_id)
+
+        if self.compact:
+            record = (self.db_links.find_one({'_id': key})
+                      if key is not None else None)
+        else:
+            record = self.db_links.find_one({'ProteinID': key})
+
+        if not record:
+            return None
+
+        return ProteinLink.from_document(record, self.codec).taxid
+
     def protein_taxid(self, protein_id):
         """Translates protein id to taxonomy id"""
 
-        record = self.db_links.find_one({'ProteinID':protein_id})
+        taxid = self.find_protein_taxid(protein_id)
 
-        if not record:
+        if taxid is None:
             raise NoProteinLink(protein_acc=protein_id)
 
-        return record['TaxID']
+        return taxid
+
+    @autoreconnect_retry
+    def protein_taxids(self, protein_ids):
+        """Translates a batch of protein ids to taxonomy ids in a single query.
+
+        Params:
+            protein_ids (list): Protein accessions
+
+        Returns:
+            taxids (dict): {protein_id: taxid} pairs for accessions that
+                           exist in the database. Missing ones are left out.
+        """
+
+        if not self.compact:
+            cursor = self.db_links.find(
+                {'ProteinID': {'$in': list(protein_ids)}},
+                {'ProteinID': 1, 'TaxID': 1, '_id': 0})
+
+            return dict((record['ProteinID'], record['TaxID'])
+                        for record in cursor)
+
+        keys = dict((self.codec.encode(protein_id), protein_id)
+                    for protein_id in protein_ids)
+
+        # Prefixes may have been registered since the dictionary was read,
+        # it is read again at most once per batch
+        if None in keys:
+            self.reload_prefixes()
+            keys = dict((self.codec.encode(protein_id), protein_id)
+                        for protein_id in protein_ids)
+
+        # Accessions with unknown prefixes cannot be in the database
+        keys.pop(None, None)
+
+        cursor = self.db_links.find({'_id': {'$in': list(keys)}})
+
+        return dict((keys[record['_id']], str(record['t']))
+                    for record in cursor)
+
+    def fill_taxids(self, protein_ids, taxids):
+        """Translates a batch of protein ids into a preallocated buffer.
+
+        Params:
+            protein_ids (list): Protein accessions
+            taxids (list): Buffer of the same length as protein_ids
+
+        Returns:
+            taxids (list): Buffer filled with taxids, None where there is
+                           no link.
+        """
+
+        found = self.protein_taxids(set(protein_ids))
+
+        for i, protein_id in enumerate(protein_ids):
+            taxids[i] = found.get(protein_id)
+
+        return taxids
+
+    def current_taxonomy(self):
+        """Returns shared taxonomy, switching to a newly published file at
+        most once per SHARED_TAXONOMY_REFRESH seconds.
+
+        New file is mapped by a new object, so lookups still running in
+        other threads finish on the old version.
+
+        Returns:
+            taxonomy (SharedTaxonomy): Shared taxonomy, None if not used
+        """
+
+        if not self.shared_taxonomy or time.time() < self._next_refresh:
+            return self.shared_taxonomy
+
+        with self._refresh_lock:
+            if time.time() >= self._next_refresh:
+                self._next_refresh = (time.time() +
+                                      self.SHARED_TAXONOMY_REFRESH)
+
+                try:
+                    if self.shared_taxonomy.stale():
+                        self.shared_taxonomy = SharedTaxonomy(
+                            self.SHARED_TAXONOMY)
+                except OSError:
+                    # File is being replaced, keep the mapped version
+                    pass
+
+        return self.shared_taxonomy
+
+    @property
+    def taxonomy_version(self):
+        """Version of the shared taxonomy in use, None if not used."""
+
+        taxonomy = self.current_taxonomy()
+
+        return taxonomy.version if taxonomy else None
+
+    def find_lineage(self, taxid, max_depth=MAX_DEPTH):
+        """Retrieves phylogenetic lineage of a taxid.
+
+        Params:
+            taxid (str): NCBI taxonomy identifier.
+            max_depth (int): Maximal number of levels walked up the tree
+
+        Returns:
+            lineage (list): Lineage of an organism represented by tax
+                            identifier, None if it doesn't exist.
+        """
+
+        # Read whole lineage from the shared taxonomy, if available
+        taxonomy = self.current_taxonomy()
+        if taxonomy:
+            return taxonomy.lineage(taxid, max_depth)
+
+        return walk_lineage(taxid, self.find_node, max_depth)
+
+    def find_rank_lineage(self, taxid, ranks, max_depth=MAX_DEPTH):
+        """Retrieves names of ancestors of a taxid at given ranks.
+
+        With a shared taxonomy, ancestors at common ranks are read from
+        precomputed tables with a single lookup per rank. Otherwise the
+        nodes collection is walked, one query per level of the tree, which
+        is meant for occasional lookups only.
+
+        Params:
+            taxid (str): NCBI taxonomy identifier.
+            ranks (list): Ranks, e.g. ['superkingdom', 'phylum', 'genus']
+            max_depth (int): Maximal number of levels walked up the tree
+
+        Returns:
+            names (list): Name of the ancestor at each rank, None where
+                          there is none. None if taxid doesn't exist.
+        """
+
+        taxonomy = self.current_taxonomy()
+        if taxonomy:
+            return taxonomy.rank_lineage(taxid, ranks)
+
+        return walk_ranks(taxid, self.find_node, ranks, max_depth)
+
+    def fill_lineages(self, taxids, lineages, max_depth=MAX_DEPTH):
+        """Retrieves lineages of a batch of taxids into a preallocated
+        buffer. Nodes are retrieved with one query per level of the tree.
+
+        Params:
+            taxids (list): Taxonomy IDs, None entries are skipped
+            lineages (list): Buffer of the same length as taxids
+            max_depth (int): Maximal number of levels walked up the tree
+
+        Returns:
+            lineages (list): Buffer filled with lineages, None where taxid
+                             doesn't exist.
+        """
+
+        taxonomy = self.current_taxonomy()
+        if taxonomy:
+            for i, taxid in enumerate(taxids):
+                lineages[i] = (taxonomy.lineage(taxid, max_depth)
+                               if taxid is not None else None)
+            return lineages
+
+        nodes = self.get_ancestors(taxid for taxid in taxids
+                                   if taxid is not None)
+
+        for i, taxid in enumerate(taxids):
+            lineages[i] = (walk_lineage(taxid, nodes.get, max_depth)
+                           if taxid is not None else None)
+
+        return lineages
+
+    def get_ancestors(self, taxids, max_depth=MAX_DEPTH):
+        """Retrieves nodes of taxids and all their ancestors.
+
+        Nodes are read from the shared taxonomy, if available. Otherwise they
+        are retrieved with one query per level of the tree.
+
+        Params:
+            taxids (iterable): Taxonomy IDs
+            max_depth (int): Maximal number of levels walked up the tree
+
+        Returns:
+            nodes (dict): {taxid: Node} pairs of all nodes found
+        """
+
+        nodes = {}
+
+        taxonomy = self.current_taxonomy()
+        if taxonomy:
+            for taxid in taxids:
+                # Walk stops at nodes already retrieved, which also
+                # protects against cycles
+                for _ in range(max_depth):
+                    if taxid in nodes:
+                        break
+
+                    node = taxonomy.node(taxid)
+                    if node is None:
+                        break
+
+                    nodes[taxid] = node
+                    taxid = node.upper_hierarchy
+
+            return nodes
+
+        queried = set()
+        missing = set(taxids)
+
+        for _ in range(max_depth):
+            if not missing:
+                break
+
+            found = self.get_nodes(missing)
+            nodes.update(found)
+            queried.update(missing)
+
+            # Go one level up, stop at nodes already queried, pointing
+            # to themselves or not existing in the database
+            missing = set(node.upper_hierarchy for node in found.values())
+            missing.difference_update(queried)
+
+        return nodes
 
     def get_lineage_from_db(self, taxid, lineage=None):
         """Method retrieves phylogenetic lineage from database based on
@@ -165,29 +767,25 @@ class TaxDb(object):
 
         Params:
             tax_id (str): NCBI taxonomy identifier.
+            lineage (list): Names already collected below the taxid, from
+                            the lowest one.
 
         Returns:
             lineage (str): Lineage of an organism represented by tax identifier.
+
+        Raises:
+            NoRecord: if taxid doesn't exist
         """
 
-        # If it is the first call
-        if not lineage:
-            lineage = []
+        found = self.find_lineage(taxid)
 
-        curr_taxid = self.get_node(taxid=taxid)
+        if found is None:
+            raise NoRecord(taxid)
 
-        # Check whether it is not the highest hierarchy possible
-        if curr_taxid.taxid != curr_taxid.upper_hierarchy:
-            # if there is higher hierarchy, append and travel up the tree
-            lineage.append(curr_taxid.scientific_name)
-            try:
-                return TaxDb.get_lineage_from_db(self, curr_taxid.upper_hierarchy, lineage)
-            except NoRecord:
-                pass
+        if lineage:
+            found.extend(reversed(lineage))
 
-        lineage.append(curr_taxid.scientific_name)
-        lineage.reverse()
-        return lineage
+        return found
 
 if __name__ == "__main__":
     doctest.testmod()
@@ -0,0 +1,51 @@
+#!/usr/bin/env bash
+# Starts a local sharded MongoDB cluster for TaxDb replica / sharding tests:
+#   - shard replica set 'rs0' of three mongod processes (ports 27018-27020)
+#   - config server replica set 'cfg' (port 27021)
+#   - two mongos routers (ports 27022 and 27023)
+# Data and logs are kept in the directory given as the first argument
+# (default: /tmp/taxdb_cluster). Stop the cluster with:
+#   pkill -f taxdb_cluster
+
+set -e
+
+CLUSTER_DIR=${1:-/tmp/taxdb_cluster}
+MONGO_SHELL=$(command -v mongosh || command -v mongo)
+
+mkdir -p "$CLUSTER_DIR"
+
+for port in 27018 27019 27020; do
+    mkdir -p "$CLUSTER_DIR/rs0_$port"
+    mongod --shardsvr --replSet rs0 --port $port --bind_ip localhost \
+           --dbpath "$CLUSTER_DIR/rs0_$port" \
+           --logpath "$CLUSTER_DIR/rs0_$port.log" --fork
+done
+
+mkdir -p "$CLUSTER_DIR/cfg_27021"
+mongod --configsvr --replSet cfg --port 27021 --bind_ip localhost \
+       --dbpath "$CLUSTER_DIR/cfg_27021" \
+       --logpath "$CLUSTER_DIR/cfg_27021.log" --fork
+
+$MONGO_SHELL --quiet --port 27018 --eval '
+rs.initiate({_id: "rs0", members: [{_id: 0, host: "localhost:27018"},
+                                   {_id: 1, host: "localhost:27019"},
+                                   {_id: 2, host: "localhost:27020"}]})'
+$MONGO_SHELL --quiet --port 27021 --eval '
+rs.initiate({_id: "cfg", configsvr: true,
+             members: [{_id: 0, host: "localhost:27021"}]})'
+
+# Wait for both replica sets to elect primaries
+for port in 27018 27021; do
+    until $MONGO_SHELL --quiet --port $port \
+            --eval 'quit(db.hello().isWritablePrimary ? 0 : 1)'; do
+        sleep 1
+    done
+done
+
+for port in 27022 27023; do
+    mongos --configdb cfg/localhost:27021 --port $port --bind_ip localhost \
+           --logpath "$CLUSTER_DIR/mongos_$port.log" --fork
+done
+
+$MONGO_SHELL --quiet --port 27022 --eval '
+sh.addShard("rs0/localhost:27018,localhost:27019,localhost:27020")'
@@ -0,0 +1,93 @@
+"""Unit tests for changes between taxonomy releases"""
+
+import unittest
+import os
+import sys
+import tempfile
+
+# Assures that even if package is not installed, or codebase
+# is in isolated environment, developer can run tests.
+sys.path.insert(0, os.path.abspath('..'))
+
+# Import module we gonna test
+from changeset import ChangeSet, diff_nodes, diff_links, build_changeset
+from own_objects import Node
+
+
+class TestChangeSet(unittest.TestCase):
+    """Class for testing changeset module"""
+
+    def test_read(self):
+        """Tests ChangeSet.read method"""
+
+        file_path = os.path.join(tempfile.mkdtemp(), 'changes.tsv')
+        with open(file_path, 'w') as handle:
+            handle.write('T\t2\tBacteria\nT\t6\tAzorhizobium\nA\tP06912\n')
+
+        # Method we want to test
+        changes = ChangeSet.read(file_path)
+
+        self.assertSetEqual(set1=changes.taxids, set2={'2', '6'})
+        self.assertSetEqual(set1=changes.names, set2={'Bacteria',
+                                                      'Azorhizobium'})
+        self.assertSetEqual(set1=changes.accessions, set2={'P06912'})
+        self.assertTrue(changes.links_compared)
+
+    def test_build_changeset(self):
+        """Tests changeset.build_changeset with missing links files"""
+
+        directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        out_file = os.path.join(directories[0], 'changes.tsv')
+
+        for directory, name in zip(directories, ['Bacteria', 'Eubacteria']):
+            with open(os.path.join(directory, 'names.dmp'), 'w') as handle:
+                handle.write('1\t|\troot\t|\t\t|\tscientific name\t|\n'
+                             '2\t|\t%s\t|\t\t|\tscientific name\t|\n'
+                             % name)
+            with open(os.path.join(directory, 'nodes.dmp'), 'w') as handle:
+                handle.write('1\t|\t1\t|\tno rank\t|\n'
+                             '2\t|\t1\t|\tsuperkingdom\t|\n')
+
+        # Links cannot be silently left out
+        with self.assertRaises(IOError):
+            build_changeset(directories[0], directories[1], out_file)
+
+        build_changeset(directories[0], directories[1], out_file,
+                        skip_links=True)
+        changes = ChangeSet.read(out_file)
+
+        self.assertSetEqual(set1=changes.taxids, set2={'2'})
+        self.assertFalse(changes.links_compared)
+
+    def test_diff_nodes(self):
+        """Tests changeset.diff_nodes"""
+
+        old = [Node('2', 'Bacteria', '131567'),
+               Node('6', 'Azorhizobium', '2'),
+               Node('9', 'Buchnera', '32199'),
+               Node('10', 'Cellvibrio', '1706371')]
+        new = [Node('2', 'Bacteria', '131567'),
+               Node('6', 'Azorhizobium', '2'),
+               Node('7', 'Azorhizobium caulinodans', '6'),
+               Node('9', 'Buchnera aphidicola', '32199')]
+
+        # Renamed and removed nodes, new ones are not listed
+        result = [(node.taxid, node.scientific_name)
+                  for node in diff_nodes(old, new)]
+
+        self.assertListEqual(list1=result, list2=[('9', 'Buchnera'),
+                                                  ('10', 'Cellvibrio')])
+
+    def test_diff_links(self):
+        """Tests changeset.diff_links"""
+
+        old = [('P02753', '9606'), ('P06912', '9986'), ('P18902', '9913')]
+        new = [('P06912', '9986'), ('P18902', '9606'), ('P22935', '10090')]
+
+        result = list(diff_links(old, new))
+
+        self.assertListEqual(list1=result,
+                             list2=['P02753', 'P18902', 'P22935'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,13 +3,18 @@
 import unittest
 import os
 import sys
+import tempfile
 
 # Assures that even if package is not installed, or codebase
 # is in isolated environment, developer can run tests.
 sys.path.insert(0, os.path.abspath('..'))
 
 # Import module we gonna test
-from mapper import version_to_accession, read_protein_acc
+from mapper import version_to_accession, read_protein_acc, tag_defline, \
+    tag_taxid, read_chunks, annotate_chunk, LineageDictionary, rollup_counts, \
+    split_tag, needs_refresh, LineageCache, write_table, \
+    map_taxonomies_offline, parse_arguments
+from changeset import ChangeSet
 
 
 class TestMapper(unittest.TestCase):
@@ -45,6 +50,262 @@ class TestMapper(unittest.TestCase):
         # Assert whether we get what we want
         self.assertListEqual(list1=result, list2=expected)
 
+        # Empty deflines have no accession
+        self.assertIsNone(read_protein_acc(''))
+        self.assertIsNone(read_protein_acc('\n'))
+
+    def test_tag_defline(self):
+        """Tests tag_defline method"""
+
+        result = tag_defline('>P1 protein\n', ['cellular organisms',
+                                                'Bacteria'])
+
+        expected = '>P1 protein #| cellular organisms<->Bacteria |#\n'
+
+        self.assertEqual(first=result, second=expected)
+
+    def test_tag_taxid(self):
+        """Tests tag_taxid method"""
+
+        result = tag_taxid('>P1 protein\n', '2')
+
+        expected = '>P1 protein #| taxid:2 |#\n'
+
+        self.assertEqual(first=result, second=expected)
+
+    def test_lineage_dictionary(self):
+        """Tests LineageDictionary class"""
+
+        written = []
+
+        class Handle(object):
+            def write(self, line):
+                written.append(line)
+
+        dictionary = LineageDictionary(Handle())
+
+        # Method we want to test
+        result = [dictionary.get_id('2', ['root', 'Bacteria']),
+                  dictionary.get_id('9', ['root', 'Archaea']),
+                  dictionary.get_id('2', ['root', 'Bacteria'])]
+
+        # Each lineage gets an ID and is written only once
+        self.assertListEqual(list1=result, list2=[1, 2, 1])
+        self.assertListEqual(list1=written,
+                             list2=['1\troot<->Bacteria\n',
+                                    '2\troot<->Archaea\n'])
+
+        # Lineages at selected ranks are shared by taxids
+        del written[:]
+        dictionary = LineageDictionary(Handle(), '\t', by_lineage=True)
+
+        result = [dictionary.get_id('6', ['Bacteria', '-']),
+                  dictionary.get_id('7', ['Bacteria', '-']),
+                  dictionary.get_id('9', ['Archaea', '-'])]
+
+        self.assertListEqual(list1=result, list2=[1, 1, 2])
+        self.assertListEqual(list1=written,
+                             list2=['1\tBacteria\t-\n', '2\tArchaea\t-\n'])
+
+    def test_rank_lineage_cache(self):
+        """Tests LineageCache class with ranks"""
+
+        class Database(object):
+            taxonomy_version = None
+
+            def find_rank_lineage(self, taxid, ranks):
+                if taxid == '6':
+                    return ['Bacteria', None, 'Azorhizobium']
+
+        cache = LineageCache(Database(), ranks=['superkingdom', 'phylum',
+                                                'genus'])
+
+        # Missing ranks get a placeholder, unknown taxids an empty lineage
+        self.assertListEqual(list1=cache.get('6'),
+                             list2=['Bacteria', '-', 'Azorhizobium'])
+        self.assertListEqual(list1=cache.get('3'), list2=[])
+
+    def test_write_table(self):
+        """Tests write_table method"""
+
+        class Database(object):
+            taxonomy_version = None
+
+            def fill_taxids(self, protein_ids, taxids):
+                links = {'P1': '2', 'P2': '6', 'P3': '2'}
+                for i, protein_id in enumerate(protein_ids):
+                    taxids[i] = links.get(protein_id)
+                return taxids
+
+            def find_lineage(self, taxid):
+                # Lineage of taxid 6 cannot be resolved
+                if taxid == '2':
+                    return ['root', 'Bacteria']
+
+        class Handle(object):
+            def __init__(self):
+                self.lines = []
+
+            def write(self, line):
+                self.lines.append(line)
+
+        database = Database()
+        table, lineages = Handle(), Handle()
+
+        chunks = [['>P1\n', 'SEQ\n', '>P2\n'], ['>P3\n', '>P4\n']]
+        write_table(chunks, table, lineages, database, LineageCache(database))
+
+        # Unmapped accession is left out, unresolved lineage has no ID
+        self.assertListEqual(list1=table.lines,
+                             list2=['P1\t2\t1\n', 'P2\t6\t\n', 'P3\t2\t1\n'])
+        self.assertListEqual(list1=lineages.lines,
+                             list2=['1\troot<->Bacteria\n'])
+
+    def test_map_taxonomies_offline(self):
+        """Tests map_taxonomies_offline method"""
+
+        directory = tempfile.mkdtemp()
+
+        def write(file_name, lines):
+            """Writes lines to a file in the temporary directory"""
+            file_path = os.path.join(directory, file_name)
+            with open(file_path, 'w') as handle:
+                handle.writelines(lines)
+            return file_path
+
+        nodes_file = write('nodes.dmp', [
+            '%s\t|\t%s\t|\tno rank\t|\n' % node
+            for node in [('1', '1'), ('2', '131567'), ('6', '2'), ('7', '6'),
+                         ('131567', '1')]])
+        names_file = write('names.dmp', [
+            '%s\t|\t%s\t|\t\t|\tscientific name\t|\n' % name
+            for name in [('1', 'root'), ('2', 'Bacteria'),
+                         ('6', 'Azorhizobium'), ('7', 'A. caulinodans'),
+                         ('131567', 'cellular organisms')]])
+        links_file = write('links.txt', [
+            'accession\taccession.version\ttaxid\tgi\n',
+            'P3\tP3.1\t2\t3\n',
+            'P1\tP1.1\t7\t1\n',
+            'P9\tP9.1\t6\t9\n'])
+
+        # Duplicated accession, unmapped accession and an empty defline
+        in_file = write('in.fasta', ['>P1.1 first\n', 'SEQ\n', '>P2 unknown\n',
+                                     '>\n', '>P3\n', 'SEQ\n', 'SEQ\n',
+                                     '>P1 again\n'])
+        out_file = os.path.join(directory, 'out.fasta')
+
+        # Buffer smaller than the number of records spills sorted runs
+        map_taxonomies_offline(in_file, out_file, links_file, nodes_file,
+                               names_file, buffer_size=2, tmp_dir=directory)
+
+        bacteria = 'cellular organisms<->Bacteria'
+        caulinodans = bacteria + '<->Azorhizobium<->A. caulinodans'
+
+        with open(out_file, 'r') as handle:
+            self.assertListEqual(list1=handle.readlines(),
+                                 list2=['>P1.1 first #| %s |#\n' % caulinodans,
+                                        'SEQ\n', '>P2 unknown\n', '>\n',
+                                        '>P3 #| %s |#\n' % bacteria,
+                                        'SEQ\n', 'SEQ\n',
+                                        '>P1 again #| %s |#\n' % caulinodans])
+
+        map_taxonomies_offline(in_file, out_file, links_file,
+                               output_format='taxid', links_sorted=False)
+
+        with open(out_file, 'r') as handle:
+            self.assertListEqual(list1=[line for line in handle
+                                        if '#|' in line],
+                                 list2=['>P1.1 first #| taxid:7 |#\n',
+                                        '>P3 #| taxid:2 |#\n',
+                                        '>P1 again #| taxid:7 |#\n'])
+
+    def test_ranks_arguments(self):
+        """Tests parsing of --ranks option"""
+
+        args = parse_arguments(['-i', 'in', '-o', 'out',
+                                '--ranks', 'superkingdom, ,genus,'])
+
+        self.assertListEqual(list1=args.ranks,
+                             list2=['superkingdom', 'genus'])
+
+        # Options writing no lineages or without rank lookups are rejected
+        for argv in (['-f', 'taxid'], ['-s', 'http://localhost:8765'],
+                     ['-p', 'tsv'], ['-r', 'changes.tsv']):
+            with self.assertRaises(SystemExit):
+                parse_arguments(['-i', 'in', '-o', 'out',
+                                 '--ranks', 'genus'] + argv)
+
+    def test_read_chunks(self):
+        """Tests read_chunks method"""
+
+        lines = ['>P1\n', 'SEQ\n', '>P2\n', 'SEQ\n', 'SEQ\n', '>P3\n']
+
+        # Method we want to test
+        result = list(read_chunks(lines, batch_size=2))
+
+        # Each chunk contains at most 2 deflines
+        expected = [['>P1\n', 'SEQ\n', '>P2\n'],
+                    ['SEQ\n', 'SEQ\n', '>P3\n']]
+
+        self.assertListEqual(list1=result, list2=expected)
+
+    def test_annotate_chunk(self):
+        """Tests annotate_chunk method"""
+
+        lines = ['>P1\n', 'SEQ\n', '>P2\n']
+
+        # Annotate deflines only, other lines stay where they were
+        result = annotate_chunk(lines,
+                                lambda deflines: [d.strip() + ' #| A |#\n'
+                                                  for d in deflines])
+
+        expected = ['>P1 #| A |#\n', 'SEQ\n', '>P2 #| A |#\n']
+
+        self.assertListEqual(list1=result, list2=expected)
+
+    def test_rollup_counts(self):
+        """Tests rollup_counts method"""
+
+        # Tree with a cycle between 8 and 9, which has to be survived
+        parents = {'1': '1', '2': '1', '6': '2', '7': '6', '8': '9', '9': '8'}
+        counts = {'7': 3, '2': 1, '8': 1, '10': 2}
+
+        # Method we want to test
+        result = rollup_counts(counts, parents)
+
+        self.assertEqual(first=result['1'], second=4)
+        self.assertEqual(first=result['2'], second=4)
+        self.assertEqual(first=result['6'], second=3)
+        self.assertEqual(first=result['7'], second=3)
+
+        # Taxid without a node keeps its own count
+        self.assertEqual(first=result['10'], second=2)
+
+    def test_needs_refresh(self):
+        """Tests split_tag and needs_refresh methods"""
+
+        changes = ChangeSet()
+        changes.taxids.update(['2', '5'])
+        changes.names.add('Bacteria')
+        changes.accessions.add('P9')
+
+        deflines = ['>P1 a #| cellular organisms<->Bacteria |#\n',
+                    '>P2 b #| cellular organisms<->Archaea |#\n',
+                    '>P3 c #| taxid:5 |#\n',
+                    '>P4 d #| taxid:6 |#\n',
+                    '>P9 e\n',
+                    '>P8 f\n']
+
+        result = []
+        for defline in deflines:
+            defline, tag = split_tag(defline)
+            result.append(needs_refresh(read_protein_acc(defline[1:]),
+                                        tag, changes))
+
+        expected = [True, False, True, False, True, False]
+
+        self.assertListEqual(list1=result, list2=expected)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,116 @@
+"""Unit tests for the resident mapping server"""
+
+import unittest
+import os
+import sys
+import threading
+
+from urllib.error import HTTPError
+
+# Assures that even if package is not installed, or codebase
+# is in isolated environment, developer can run tests.
+sys.path.insert(0, os.path.abspath('..'))
+
+# Import module we gonna test
+from mapperserver import MappingServer
+from mapper import query_server
+
+
+class StubDatabase(object):
+    """Database with two linked proteins, P1 and P2"""
+
+    taxonomy_version = None
+    broken = False
+
+    def fill_taxids(self, protein_ids, taxids):
+        if self.broken:
+            raise RuntimeError('database is down')
+
+        links = {'P1': '2', 'P2': '6'}
+        for i, protein_id in enumerate(protein_ids):
+            taxids[i] = links.get(protein_id)
+
+        return taxids
+
+    def find_lineage(self, taxid):
+        lineages = {'2': ['cellular organisms', 'Bacteria'],
+                    '6': ['cellular organisms', 'Bacteria', 'Azorhizobium']}
+        return lineages.get(taxid)
+
+
+class TestMappingServer(unittest.TestCase):
+    """Class for testing mapperserver module"""
+
+    def setUp(self):
+        self.database = StubDatabase()
+
+        # Port 0 lets the system pick a free port
+        self.server = MappingServer(('localhost', 0), self.database,
+                                    batch_size=2)
+        self.url = 'http://localhost:%d' % self.server.server_address[1]
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_deflines(self):
+        """Tests /deflines endpoint"""
+
+        deflines = ['>P1 protein\n', '>P3 unknown\n', '>', '>P2\n']
+        result = query_server(self.url, '/deflines', {'deflines': deflines})
+
+        # Deflines which cannot be mapped are returned as they are
+        expected = ['>P1 protein #| cellular organisms<->Bacteria |#\n',
+                    '>P3 unknown\n',
+                    '>',
+                    '>P2 #| cellular organisms<->Bacteria<->Azorhizobium |#\n']
+
+        self.assertDictEqual(d1=result, d2={'deflines': expected})
+
+        result = query_server(self.url, '/deflines',
+                              {'deflines': ['>P1\n'], 'format': 'taxid'})
+
+        self.assertDictEqual(d1=result,
+                             d2={'deflines': ['>P1 #| taxid:2 |#\n']})
+
+    def test_lineages(self):
+        """Tests /lineages endpoint"""
+
+        result = query_server(self.url, '/lineages',
+                              {'accessions': ['P1', 'P3']})
+
+        expected = {'lineages': {'P1': ['cellular organisms', 'Bacteria'],
+                                 'P3': None}}
+
+        self.assertDictEqual(d1=result, d2=expected)
+
+    def test_errors(self):
+        """Tests responses to malformed requests and failures"""
+
+        def status(path, payload):
+            """Returns HTTP status code of a failed request"""
+            with self.assertRaises(HTTPError) as context:
+                query_server(self.url, path, payload)
+            return context.exception.code
+
+        self.assertEqual(first=status('/deflines', {'deflines': 'abc'}),
+                         second=400)
+        self.assertEqual(first=status('/deflines', {'deflines': [1]}),
+                         second=400)
+        self.assertEqual(first=status('/deflines', {'deflines': [],
+                                                    'format': 'tsv'}),
+                         second=400)
+        self.assertEqual(first=status('/lineages', {}), second=400)
+        self.assertEqual(first=status('/unknown', {}), second=404)
+
+        # Database failure is reported instead of closing the connection
+        self.database.broken = True
+        self.assertEqual(first=status('/lineages', {'accessions': ['P1']}),
+                         second=500)
+
+if __name__ == '__main__':
+    unittest.main()
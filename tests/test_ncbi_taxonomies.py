@@ -3,6 +3,7 @@
 import unittest
 import os
 import sys
+import tempfile
 
 # Assures that even if package is not installed, or codebase
 # is in isolated environment, developer can run tests.
@@ -10,6 +11,7 @@ sys.path.insert(0, os.path.abspath('..'))
 
 # Import module we gonna test
 import ncbi_taxonomies as tax
+from own_exceptions import DoubleRelies, MissingParent, NoRecord
 
 class TestNCBITaxonomies(unittest.TestCase):
     """Class for testing ncbi_taxonomies module"""
@@ -65,5 +67,84 @@ class TestNCBITaxonomies(unittest.TestCase):
         # Assert if it works
         self.assertDictEqual(d1=links, d2=expected)
 
+    def test_join_nodes(self):
+        """Tests ncbi_taxonomies.join_nodes"""
+
+        test_files = os.path.join(os.path.dirname(__file__), 'test_files')
+
+        # Join test files in batches of two nodes
+        batches = list(tax.join_nodes(
+            os.path.join(test_files, 'test_join_names.dmp'),
+            os.path.join(test_files, 'test_join_nodes.dmp'),
+            batch_size=2))
+
+        result = [[node.post_format() for node in batch] for batch in batches]
+
+        # What we expect, root node pointing to itself is skipped
+        expected = [[{'TaxID': '2', 'SciName': 'Bacteria', 'Parent': '131567',
+                      'Rank': 'superkingdom'},
+                     {'TaxID': '6', 'SciName': 'Azorhizobium', 'Parent': '2',
+                      'Rank': 'genus'}],
+                    [{'TaxID': '7', 'SciName': 'Azorhizobium caulinodans',
+                      'Parent': '6', 'Rank': 'species'},
+                     {'TaxID': '131567', 'SciName': 'cellular organisms',
+                      'Parent': '1', 'Rank': 'no rank'}]]
+
+        self.assertListEqual(list1=result, list2=expected)
+
+    def test_build_lineage(self):
+        """Tests ncbi_taxonomies.build_lineage"""
+
+        parents = {'2': '131567', '6': '2', '131567': '1'}
+        names = {'1': 'root', '2': 'Bacteria', '131567': 'cellular organisms'}
+
+        self.assertListEqual(list1=tax.build_lineage('2', parents, names),
+                             list2=['cellular organisms', 'Bacteria'])
+        self.assertIsNone(tax.build_lineage('3', parents, names))
+
+        # Node without a scientific name
+        with self.assertRaises(NoRecord):
+            tax.build_lineage('6', parents, names)
+
+    def test_join_nodes_errors(self):
+        """Tests ncbi_taxonomies.join_nodes on malformed dumps"""
+
+        def join(nodes, names=range(1, 4)):
+            """Joins names with given nodes written to temporary files"""
+
+            directory = tempfile.mkdtemp()
+            names_file = os.path.join(directory, 'names.dmp')
+            nodes_file = os.path.join(directory, 'nodes.dmp')
+
+            with open(names_file, 'w') as handle:
+                handle.write(''.join('%d\t|\tN%d\t|\t\t|\tscientific name\t|\n'
+                                     % (i, i) for i in names))
+            with open(nodes_file, 'w') as handle:
+                handle.write(''.join('%s\t|\t%s\t|\tno rank\t|\n' % node
+                                     for node in nodes))
+
+            return tax.join_nodes(names_file, nodes_file, batch_size=1)
+
+        # Duplicated taxid
+        # Duplicated taxid is found before any batch is yielded
+        with self.assertRaises(DoubleRelies):
+            next(join([('1', '1'), ('2', '1'), ('3', '1'), ('3', '1')]))
+
+        # Nodes file which is not sorted
+        with self.assertRaises(ValueError):
+            next(join([('1', '1'), ('3', '1'), ('2', '1')]))
+
+        # Parent which doesn't exist is found before any batch is yielded
+        with self.assertRaises(MissingParent):
+            next(join([('1', '1'), ('2', '1'), ('3', '5')]))
+
+        # Names file which is not sorted
+        with self.assertRaises(ValueError):
+            list(join([('1', '1'), ('2', '1'), ('3', '1')], names=[1, 3, 2]))
+
+        # Name which doesn't exist
+        with self.assertRaises(NoRecord):
+            list(join([('1', '1'), ('2', '1'), ('3', '1')], names=[1, 3]))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,189 @@
+"""Unit tests for taxonomy shared between processes"""
+
+import unittest
+import os
+import sys
+import json
+import tempfile
+import multiprocessing
+
+# Assures that even if package is not installed, or codebase
+# is in isolated environment, developer can run tests.
+sys.path.insert(0, os.path.abspath('..'))
+
+# Import module we gonna test
+from sharedtaxonomy import SharedTaxonomy, publish
+from own_objects import Node
+from taxonomydb import TaxDb
+
+
+def read_lineage(args):
+    """Reads lineage in a worker process"""
+    file_path, taxid = args
+    return SharedTaxonomy(file_path).lineage(taxid)
+
+
+class TestSharedTaxonomy(unittest.TestCase):
+    """Class for testing sharedtaxonomy module"""
+
+    def setUp(self):
+        self.file_path = os.path.join(tempfile.mkdtemp(), 'taxonomy.bin')
+
+        # Root node pointing to itself, as in the nodes dump file
+        self.nodes = [Node('1', 'root', '1'),
+                      Node('2', 'Bacteria', '131567'),
+                      Node('6', 'Azorhizobium', '2'),
+                      Node('131567', 'cellular organisms', '1')]
+
+    def test_lineage(self):
+        """Tests SharedTaxonomy.lineage method"""
+
+        publish(self.nodes, self.file_path, version=1)
+        taxonomy = SharedTaxonomy(self.file_path)
+
+        self.assertEqual(first=taxonomy.version, second=1)
+        self.assertListEqual(list1=taxonomy.lineage('6'),
+                             list2=['root', 'cellular organisms',
+                                    'Bacteria', 'Azorhizobium'])
+
+        # Taxids which don't exist
+        self.assertIsNone(taxonomy.lineage('3'))
+        self.assertIsNone(taxonomy.lineage('999999'))
+
+    def test_rank_lineage(self):
+        """Tests SharedTaxonomy.rank_lineage method"""
+
+        publish([Node('1', 'root', '1', 'no rank'),
+                 Node('2', 'Bacteria', '131567', 'superkingdom'),
+                 Node('6', 'Azorhizobium', '2', 'genus'),
+                 Node('7', 'Azorhizobium caulinodans', '6', 'species'),
+                 Node('131567', 'cellular organisms', '1', 'no rank')],
+                self.file_path)
+        taxonomy = SharedTaxonomy(self.file_path)
+
+        # Ranks with tables and a rank found by walking up the tree
+        ranks = ['superkingdom', 'phylum', 'genus', 'species', 'no rank']
+        self.assertListEqual(list1=taxonomy.rank_lineage('7', ranks),
+                             list2=['Bacteria', None, 'Azorhizobium',
+                                    'Azorhizobium caulinodans',
+                                    'cellular organisms'])
+        self.assertListEqual(list1=taxonomy.rank_lineage('2', ranks),
+                             list2=['Bacteria', None, None, None,
+                                    'cellular organisms'])
+        self.assertEqual(first=taxonomy.rank(6), second='genus')
+
+        # Taxid which doesn't exist
+        self.assertIsNone(taxonomy.rank_lineage('3', ranks))
+
+    def test_cycle(self):
+        """Tests whether lookups stop at a parent cycle"""
+
+        publish([Node('2', 'A', '3', 'clade'), Node('3', 'B', '2'),
+                 Node('4', 'C', '4', 'subgenus')], self.file_path)
+        taxonomy = SharedTaxonomy(self.file_path)
+
+        # Walk stops at the first repeated node, as in the database
+        self.assertListEqual(list1=taxonomy.lineage('2'), list2=['B', 'A'])
+        self.assertListEqual(list1=taxonomy.lineage('3'), list2=['A', 'B'])
+
+        # Rank which is not in the tables is found by walking up the tree
+        self.assertEqual(first=taxonomy.ancestor_at_rank(3, 'clade'),
+                         second=2)
+        self.assertEqual(first=taxonomy.ancestor_at_rank(3, 'subgenus'),
+                         second=-1)
+
+    def test_refresh(self):
+        """Tests SharedTaxonomy.refresh method"""
+
+        publish(self.nodes, self.file_path, version=1)
+        taxonomy = SharedTaxonomy(self.file_path)
+
+        # Nothing changed yet
+        self.assertFalse(taxonomy.stale())
+        self.assertFalse(taxonomy.refresh())
+
+        # Publish new version with a renamed node
+        self.nodes[1] = Node('2', 'Eubacteria', '131567')
+        publish(self.nodes, self.file_path, version=2)
+
+        self.assertTrue(taxonomy.stale())
+        self.assertTrue(taxonomy.refresh())
+        self.assertFalse(taxonomy.stale())
+        self.assertEqual(first=taxonomy.version, second=2)
+        self.assertListEqual(list1=taxonomy.lineage('2'),
+                             list2=['root', 'cellular organisms',
+                                    'Eubacteria'])
+
+    def test_version(self):
+        """Tests whether every publish gets a new version"""
+
+        first = publish(self.nodes, self.file_path)
+        second = publish(self.nodes, self.file_path)
+
+        self.assertGreater(a=second, b=first)
+        self.assertEqual(first=SharedTaxonomy(self.file_path).version,
+                         second=second)
+
+    def test_workers(self):
+        """Tests reading the same file from several processes"""
+
+        publish(self.nodes, self.file_path)
+
+        pool = multiprocessing.Pool(2)
+        try:
+            result = pool.map(read_lineage, [(self.file_path, '2'),
+                                             (self.file_path, '6')])
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertListEqual(list1=result[0],
+                             list2=['root', 'cellular organisms', 'Bacteria'])
+        self.assertEqual(first=result[1][-1], second='Azorhizobium')
+
+class TestSharedTaxDb(unittest.TestCase):
+    """Class for testing TaxDb reading nodes from a shared taxonomy. Nodes
+    collection is never queried, so no database server is needed."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(directory, 'taxonomy.bin')
+        cfg_file = os.path.join(directory, 'db.cfg')
+
+        publish([Node('1', 'root', '1'),
+                 Node('2', 'Bacteria', '131567', 'superkingdom'),
+                 Node('6', 'Azorhizobium', '2', 'genus'),
+                 Node('131567', 'cellular organisms', '1')], self.file_path)
+
+        with open(cfg_file, 'w') as handle:
+            json.dump({'NAME': 'test_shared_taxonomy',
+                       'SHARED_TAXONOMY': self.file_path}, handle)
+
+        self.database = TaxDb(cfg_file)
+
+    def tearDown(self):
+        self.database.disconnect()
+
+    def test_get_ancestors(self):
+        """Tests TaxDb.get_ancestors method"""
+
+        nodes = self.database.get_ancestors(['6', '2', '3'])
+
+        self.assertListEqual(list1=sorted(nodes),
+                             list2=['1', '131567', '2', '6'])
+        self.assertDictEqual(d1=nodes['6'].post_format(),
+                             d2={'TaxID': '6', 'SciName': 'Azorhizobium',
+                                 'Parent': '2', 'Rank': 'genus'})
+
+    def test_fill_lineages(self):
+        """Tests TaxDb.fill_lineages method"""
+
+        lineages = self.database.fill_lineages(['6', None, '3'], [None] * 3)
+
+        self.assertListEqual(list1=lineages,
+                             list2=[['root', 'cellular organisms',
+                                     'Bacteria', 'Azorhizobium'],
+                                    None, None])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""Unit tests for external sorting and merge joining"""
+
+import unittest
+import os
+import sys
+import random
+import tempfile
+
+# Assures that even if package is not installed, or codebase
+# is in isolated environment, developer can run tests.
+sys.path.insert(0, os.path.abspath('..'))
+
+# Import module we gonna test
+from sortmerge import external_sort, merge_join
+
+
+class TestSortMerge(unittest.TestCase):
+    """Class for testing sortmerge module"""
+
+    def test_external_sort(self):
+        """Tests sortmerge.external_sort spilling to temporary files"""
+
+        tmp_dir = tempfile.mkdtemp()
+
+        records = [('P%d' % i, str(i)) for i in range(100)]
+        random.shuffle(records)
+
+        # Sort with buffer much smaller than number of records
+        result = list(external_sort(records, key=lambda r: int(r[1]),
+                                    buffer_size=7, tmp_dir=tmp_dir))
+
+        expected = [('P%d' % i, str(i)) for i in range(100)]
+
+        self.assertListEqual(list1=result, list2=expected)
+
+        # Temporary files are removed
+        self.assertListEqual(list1=os.listdir(tmp_dir), list2=[])
+
+    def test_external_sort_passes(self):
+        """Tests sortmerge.external_sort with more runs than the fan-in"""
+
+        tmp_dir = tempfile.mkdtemp()
+
+        records = [('P%d' % i, str(i)) for i in range(1000)]
+        random.shuffle(records)
+
+        # 500 runs merged at most 4 at once
+        result = list(external_sort(records, key=lambda r: int(r[1]),
+                                    buffer_size=2, tmp_dir=tmp_dir, fan_in=4))
+
+        expected = [('P%d' % i, str(i)) for i in range(1000)]
+
+        self.assertListEqual(list1=result, list2=expected)
+        self.assertListEqual(list1=os.listdir(tmp_dir), list2=[])
+
+    def test_merge_join(self):
+        """Tests sortmerge.merge_join"""
+
+        queries = [('A', '0'), ('B', '1'), ('B', '2'), ('D', '3'), ('E', '4')]
+        links = [('B', '9606'), ('C', '10090'), ('E', '9913')]
+
+        # Method we want to test
+        result = list(merge_join(queries, links))
+
+        # What we expect
+        expected = [('1', '9606'), ('2', '9606'), ('4', '9913')]
+
+        self.assertListEqual(list1=result, list2=expected)
+
+if __name__ == '__main__':
+    unittest.main()
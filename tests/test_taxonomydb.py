@@ -17,6 +17,7 @@ sys.path.insert(0, os.path.abspath('..'))
 # Import from modules we gonna test
 from BioTaxIDMapper.taxonomydb import TaxDb
 from BioTaxIDMapper.own_objects import Node, ProteinLink
+from own_exceptions import NoRecord
 
 
 class TestTaxDb(unittest.TestCase):
@@ -147,17 +148,203 @@ class TestTaxDb(unittest.TestCase):
         # Assert if we get what we want
         self.assertEqual(first=record, second=expected)
 
-    # def test_get_lineage_from_db(self):
-    #     """Tests TaxDb.get_lineage_from_db method"""
-    #
-    #     # Method we want to test
-    #     record = self.database.get_lineage_from_db('10')
-    #
-    #     # What we expect
-    #     expected = [u'Species_lvl_%d' % i for i in range(0, 11)]
-    #
-    #     # Assert if we get what we want
-    #     self.assertListEqual(list1=record, list2=expected)
+    def test_get_lineage_from_db(self):
+        """Tests TaxDb.get_lineage_from_db method"""
+
+        # Method we want to test
+        record = self.database.get_lineage_from_db('10')
+
+        # What we expect
+        expected = [u'Species_lvl_%d' % i for i in range(0, 11)]
+
+        # Assert if we get what we want
+        self.assertListEqual(list1=record, list2=expected)
+
+        # Missing taxid still raises an exception
+        with self.assertRaises(NoRecord):
+            self.database.get_lineage_from_db('12345')
+
+    def test_find_methods(self):
+        """Tests TaxDb.find_node, find_protein_taxid and find_lineage"""
+
+        # Missing entries are reported with None instead of exceptions
+        self.assertIsNone(self.database.find_node('12345'))
+        self.assertIsNone(self.database.find_protein_taxid('P12345'))
+        self.assertIsNone(self.database.find_lineage('12345'))
+
+        self.assertEqual(first=self.database.find_protein_taxid('P3'),
+                         second=u'3')
+        self.assertListEqual(list1=self.database.find_lineage('2'),
+                             list2=[u'Species_lvl_0', u'Species_lvl_1',
+                                    u'Species_lvl_2'])
+
+    def test_lineage_cycle(self):
+        """Tests whether lineage lookup survives a parent cycle"""
+
+        # Nodes pointing to each other
+        self.db_pymongo.nodes.insert_many([
+            {'TaxID': '100', 'SciName': u'Cycle_A', 'Parent': '101'},
+            {'TaxID': '101', 'SciName': u'Cycle_B', 'Parent': '100'}])
+
+        self.assertListEqual(list1=self.database.find_lineage('100'),
+                             list2=[u'Cycle_B', u'Cycle_A'])
+
+        lineages = self.database.fill_lineages(['100'], [None])
+        self.assertListEqual(list1=lineages, list2=[[u'Cycle_B', u'Cycle_A']])
+
+    def test_fill_buffers(self):
+        """Tests TaxDb.fill_taxids and fill_lineages methods"""
+
+        protein_ids = ['P1', 'P12345', 'P2']
+
+        # Buffers preallocated by the caller
+        taxids = self.database.fill_taxids(protein_ids, [None] * 3)
+        lineages = self.database.fill_lineages(taxids, [None] * 3)
+
+        self.assertListEqual(list1=taxids, list2=[u'1', None, u'2'])
+        self.assertListEqual(list1=lineages,
+                             list2=[[u'Species_lvl_0', u'Species_lvl_1'],
+                                    None,
+                                    [u'Species_lvl_0', u'Species_lvl_1',
+                                     u'Species_lvl_2']])
+
+    @classmethod
+    def tearDownClass(cls):
+        """Cleanup after all tests run"""
+        cls.client.drop_database(cls.test_cfg['NAME'])
+
+
+class TestCompactTaxDb(unittest.TestCase):
+    """Tests for TaxDb class using compact storage schema"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Setting up temporary database for testing"""
+
+        test_cfg_file = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        'test_files/test_compact.cfg'))
+
+        cls.test_cfg = TestTaxDb.load_cfg(test_cfg_file)
+        cls.database = TaxDb(test_cfg_file)
+
+        cls.client = pymongo.MongoClient()
+        cls.db_pymongo = cls.client[cls.test_cfg['NAME']]
+
+        cls.database.add_records([Node(taxid='2',
+                                       scientific_name='Bacteria',
+                                       upper_hierarchy='131567')])
+        cls.database.add_protein_links([ProteinLink('WP_011112927', '2'),
+                                        ProteinLink('Q8I6R7', '2')])
+
+    def test_compact_documents(self):
+        """Tests whether documents are stored in the compact schema"""
+
+        node = self.db_pymongo.nodes.find_one({'_id': 2})
+        link = self.db_pymongo.links.find_one({'_id': 'Q8I6R7'})
+
+        self.assertDictEqual(d1=node,
+                             d2={'_id': 2, 'p': 131567, 'n': 'Bacteria'})
+        self.assertDictEqual(d1=link, d2={'_id': 'Q8I6R7', 't': 2})
+
+    def test_get_node(self):
+        """Tests TaxDb.get_node method"""
+
+        record = self.database.get_node('2').post_format()
+
+        expected = {'TaxID': '2',
+                    'SciName': 'Bacteria',
+                    'Parent': '131567'}
+
+        self.assertDictEqual(d1=record, d2=expected)
+
+    def test_protein_taxids(self):
+        """Tests TaxDb.protein_taxid and TaxDb.protein_taxids methods"""
+
+        self.assertEqual(first=self.database.protein_taxid('WP_011112927'),
+                         second='2')
+
+        # Accession with an unknown prefix is simply not found
+        result = self.database.protein_taxids(['WP_011112927', 'Q8I6R7',
+                                               'XP_1'])
+        expected = {'WP_011112927': '2', 'Q8I6R7': '2'}
+
+        self.assertDictEqual(d1=result, d2=expected)
+
+    def test_concurrent_prefixes(self):
+        """Tests prefixes registered by several connections"""
+
+        test_cfg_file = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        'test_files/test_compact.cfg'))
+
+        # Both connections read the dictionary before any of them writes
+        first = TaxDb(test_cfg_file)
+        second = TaxDb(test_cfg_file)
+
+        first.add_protein_links([ProteinLink('NP_000001', '2')])
+        second.add_protein_links([ProteinLink('YP_000001', '2'),
+                                  ProteinLink('NP_000002', '2')])
+
+        # Each prefix got its own code
+        prefixes = list(self.db_pymongo.prefixes.find())
+        self.assertEqual(first=len(set(prefix['_id'] for prefix in prefixes)),
+                         second=len(prefixes))
+
+        # Reader which started earlier sees prefixes added since then
+        self.assertDictEqual(d1=self.database.protein_taxids(['YP_000001',
+                                                              'NP_000002']),
+                             d2={'YP_000001': '2', 'NP_000002': '2'})
+
+        first.disconnect()
+        second.disconnect()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Cleanup after all tests run"""
+        cls.client.drop_database(cls.test_cfg['NAME'])
+
+
+@unittest.skipUnless(os.environ.get('TAXDB_TEST_CLUSTER'),
+                     'requires cluster started with start_test_cluster.sh')
+class TestClusterTaxDb(unittest.TestCase):
+    """Tests for TaxDb class connected to a local sharded cluster, with
+    reads spread across replicas"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Setting up temporary database for testing"""
+
+        test_cfg_file = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                        'test_files/test_cluster.cfg'))
+
+        cls.test_cfg = TestTaxDb.load_cfg(test_cfg_file)
+        cls.database = TaxDb(test_cfg_file)
+
+        cls.client = pymongo.MongoClient(cls.test_cfg['URI'])
+        cls.db_pymongo = cls.client[cls.test_cfg['NAME']]
+
+    def test_read_preference(self):
+        """Tests whether read preference is taken from the configuration"""
+
+        read_preference = self.database.db_links.read_preference
+
+        self.assertEqual(first=read_preference.mongos_mode,
+                         second='secondaryPreferred')
+
+    def test_shard_links(self):
+        """Tests TaxDb.shard_links method"""
+
+        self.database.shard_links()
+
+        # Read collection metadata from the config database
+        result = self.client.config.collections.find_one(
+            {'_id': '%s.links' % self.test_cfg['NAME']})
+
+        self.assertDictEqual(d1=result['key'], d2={'ProteinID': 'hashed'})
+
+        # Sharded collection is still readable through TaxDb
+        self.database.add_protein_links([ProteinLink('P1', '1')])
+        self.assertDictEqual(d1=self.database.protein_taxids(['P1', 'P2']),
+                             d2={'P1': '1'})
 
     @classmethod
     def tearDownClass(cls):
@@ -22,7 +22,6 @@ from os import sys
 # Internal modules import
 import ncbi_taxonomies as ncbi
 from taxonomydb import TaxDb
-from own_objects import Node, ProteinLink
 
 # Directory where all files from NCBI have been downloaded and extracted
 ncbi_download = sys.argv[1]
@@ -40,25 +39,14 @@ def update_nodes(names_file=None, nodes_file=None):
         nodes_file = '%s/nodes.dmp' % ncbi_download
 
     print('Updating nodes collection in the database...')
-    names = ncbi.read_names_dump(names_file)
-    nodes = ncbi.read_nodes_dump(nodes_file)
-
 
     # Initialize connection with a database
     database = TaxDb()
 
-    # Go through NCBI taxonomy dump records, update if record
-    # doesn't exist
-    for taxid, parent_taxid in nodes.iteritems():
-
-        # If given taxid record does not exist
-        # in a local database, create Node object
-        # and create document in a database
-        new_node = Node(taxid=taxid,
-                        scientific_name=names[taxid],
-                        upper_hierarchy=parent_taxid,)
-
-        database.add_record(node=new_node)
+    # Go through NCBI taxonomy dump records, both sorted by taxid, joined
+    # in batches of nodes. Records which already exist are not inserted.
+    for nodes in ncbi.join_nodes(names_file, nodes_file):
+        database.add_records(nodes)
 
     # Always disconnect the database!
     database.disconnect()
@@ -76,6 +64,11 @@ def update_links(links_file=None):
 
     database = TaxDb()
 
+    # Links collection has to be sharded before it is filled
+    if database.SHARD_LINKS:
+        print('Sharding links collection...')
+        database.shard_links()
+
     for link in ncbi.protein_taxid_links(file_path=links_file):
         database.add_protein_link(link)
 